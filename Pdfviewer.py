@@ -1,6 +1,13 @@
 from flask import Flask, request, render_template_string, send_from_directory, redirect, url_for
 from werkzeug.utils import secure_filename
+from PyPDF2.errors import PdfReadError
+import json
 import os
+import uuid
+import metadata
+import pdf_tools
+import previews
+import uploads
 
 app = Flask(__name__)
 UPLOAD_FOLDER = 'uploads'
@@ -8,10 +15,22 @@ ALLOWED_EXTENSIONS = {'pdf'}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Linearize uploads ("fast web view") when pikepdf or qpdf is available
+app.config['LINEARIZE_UPLOADS'] = True
+
 # Ensure the upload folder exists
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# Uploads streamed to memory or disk as they arrive, checked to be PDFs
+uploads.init_app(app)
+
+# Per-document metadata index, built when a file is uploaded
+metadata.init_app(app)
+
+# Server-side page previews, cached under uploads/previews
+previews.init_app(app)
+
 # Check if the uploaded file is a PDF
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -62,18 +81,45 @@ def upload_file():
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], f".{uuid.uuid4().hex}.tmp")
+        uploads.save_file(file, tmp_path)
+        try:
+            if app.config['LINEARIZE_UPLOADS'] and pdf_tools.can_linearize():
+                try:
+                    pdf_tools.linearize(tmp_path, filepath)
+                except Exception:
+                    # Files qpdf can't rewrite are stored as uploaded
+                    os.replace(tmp_path, filepath)
+            else:
+                os.replace(tmp_path, filepath)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        try:
+            metadata.index_file(filepath)
+        except PdfReadError:
+            os.remove(filepath)
+            return "Invalid PDF file", 400
         return redirect(url_for('view_pdf', filename=filename))
     return "Invalid file format", 400
 
-# Serve uploaded PDF files
+# Serve uploaded PDF files. Single byte ranges (206), If-Range, ETag and
+# Last-Modified validators and conditional GETs (304) are honoured, so PDF.js
+# can fetch just the parts of a large document it needs.
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_from_directory(app.config['UPLOAD_FOLDER'], filename, mimetype='application/pdf',
+                               conditional=True, etag=True, max_age=0)
 
-# Route to display the PDF using PDF.js
+# Route to display the PDF. The page sizes are embedded so the whole document
+# can be laid out (and the scrollbar sized) up front; only the pages in and
+# just below the visible area are drawn, and pages scrolled away from are
+# cleared, so client memory stays constant whatever the page count. Pages
+# are server-rendered previews when the server can rasterize, else PDF.js
+# renders them into a small pool of recycled canvases.
 @app.route('/view/<filename>')
 def view_pdf(filename):
+    info = previews.preview_info(filename)
     return f'''
     <!DOCTYPE html>
     <html lang="en">
@@ -89,16 +135,23 @@ def view_pdf(filename):
                 font-family: Arial, sans-serif;
             }}
             #pdf-container {{
+                position: relative;
                 width: 100%;
                 height: 100vh;
                 overflow: auto;
                 background: #f0f0f0;
                 text-align: center;
             }}
-            canvas {{
+            .page {{
                 margin: 10px auto;
                 display: block;
                 border: 1px solid #ccc;
+                background: #fff;
+            }}
+            .page canvas, .page img {{
+                display: block;
+                width: 100%;
+                height: 100%;
             }}
         </style>
     </head>
@@ -107,28 +160,141 @@ def view_pdf(filename):
         <div id="pdf-container"></div>
         <script>
             const url = '/uploads/{filename}';
+            const previewUrl = '/preview/{filename}';
+            const info = {json.dumps(info)};
             const pdfContainer = document.getElementById('pdf-container');
 
-            // Load PDF
-            const loadingTask = pdfjsLib.getDocument(url);
-            loadingTask.promise.then(pdf => {{
-                for (let pageNumber = 1; pageNumber <= pdf.numPages; pageNumber++) {{
-                    pdf.getPage(pageNumber).then(page => {{
-                        const viewport = page.getViewport({{ scale: 1.5 }});
-                        const canvas = document.createElement('canvas');
-                        const context = canvas.getContext('2d');
+            // Pages drawn beyond the bottom of the visible area
+            const PREFETCH = 2;
+            const width = Math.min(pdfContainer.clientWidth - 40, 1000);
+            const pages = [];
+            const drawn = new Map();
+
+            // One empty placeholder per page, sized from the page's dimensions
+            info.sizes.forEach(([pageWidth, pageHeight], index) => {{
+                const page = document.createElement('div');
+                page.className = 'page';
+                page.style.width = width + 'px';
+                page.style.height = Math.round(width * pageHeight / pageWidth) + 'px';
+                pdfContainer.appendChild(page);
+                pages.push(page);
+            }});
+
+            // Server-rendered previews at the smallest scale that is sharp enough
+            const previewRenderer = {{
+                draw(pageNumber, page) {{
+                    const format = info.formats.includes('webp') ? 'webp' : 'png';
+                    const pixels = width * window.devicePixelRatio;
+                    const pageWidth = info.sizes[pageNumber - 1][0];
+                    const scale = info.scales.find(s => s * pageWidth >= pixels) || info.scales[info.scales.length - 1];
+                    const img = document.createElement('img');
+                    img.src = `${{previewUrl}}/${{pageNumber}}.${{format}}?scale=${{scale}}`;
+                    page.appendChild(img);
+                    return img;
+                }},
+                clear(img) {{
+                    img.removeAttribute('src');
+                    img.remove();
+                }}
+            }};
+
+            // PDF.js, fetching the document in ranges on demand and drawing into
+            // canvases taken from a pool that cleared pages return theirs to
+            const canvasPool = [];
+            let pdfDocument = null;
+            const pdfjsRenderer = {{
+                draw(pageNumber, page) {{
+                    const canvas = canvasPool.pop() || document.createElement('canvas');
+                    page.appendChild(canvas);
+                    const entry = {{ canvas: canvas, task: null, page: null, cleared: false }};
+                    pdfDocument.getPage(pageNumber).then(pdfPage => {{
+                        if (entry.cleared) return;
+                        const pageWidth = pdfPage.getViewport({{ scale: 1 }}).width;
+                        const viewport = pdfPage.getViewport({{ scale: width * window.devicePixelRatio / pageWidth }});
                         canvas.width = viewport.width;
                         canvas.height = viewport.height;
-                        pdfContainer.appendChild(canvas);
-
-                        const renderContext = {{
-                            canvasContext: context,
+                        entry.page = pdfPage;
+                        entry.task = pdfPage.render({{
+                            canvasContext: canvas.getContext('2d'),
                             viewport: viewport
-                        }};
-                        page.render(renderContext);
+                        }});
+                        entry.task.promise.catch(() => {{}});
                     }});
+                    return entry;
+                }},
+                clear(entry) {{
+                    entry.cleared = true;
+                    if (entry.task) entry.task.cancel();
+                    if (entry.page) entry.page.cleanup();
+                    entry.canvas.remove();
+                    entry.canvas.width = entry.canvas.height = 0;
+                    canvasPool.push(entry.canvas);
                 }}
-            }});
+            }};
+
+            let renderer = null;
+
+            // First page whose bottom edge is below offset, by binary search
+            function pageAt(offset) {{
+                let low = 0, high = pages.length - 1;
+                while (low < high) {{
+                    const middle = (low + high) >> 1;
+                    const page = pages[middle];
+                    if (page.offsetTop + page.offsetHeight < offset) low = middle + 1;
+                    else high = middle;
+                }}
+                return low + 1;
+            }}
+
+            // Draw the visible pages plus the prefetch window, clear the rest
+            function update() {{
+                if (!pages.length) return;
+                const top = pdfContainer.scrollTop;
+                const first = Math.max(1, pageAt(top) - 1);
+                const last = Math.min(pages.length, pageAt(top + pdfContainer.clientHeight) + PREFETCH);
+                for (const [pageNumber, entry] of drawn) {{
+                    if (pageNumber < first || pageNumber > last) {{
+                        renderer.clear(entry);
+                        drawn.delete(pageNumber);
+                    }}
+                }}
+                for (let pageNumber = first; pageNumber <= last; pageNumber++) {{
+                    if (!drawn.has(pageNumber)) {{
+                        drawn.set(pageNumber, renderer.draw(pageNumber, pages[pageNumber - 1]));
+                    }}
+                }}
+            }}
+
+            let scheduled = false;
+            function scheduleUpdate() {{
+                if (scheduled) return;
+                scheduled = true;
+                requestAnimationFrame(() => {{
+                    scheduled = false;
+                    update();
+                }});
+            }}
+
+            function start(pageRenderer) {{
+                renderer = pageRenderer;
+                pdfContainer.addEventListener('scroll', scheduleUpdate);
+                window.addEventListener('resize', scheduleUpdate);
+                update();
+            }}
+
+            if (info.renderer) {{
+                start(previewRenderer);
+            }} else {{
+                pdfjsLib.getDocument({{
+                    url: url,
+                    rangeChunkSize: 65536,
+                    disableAutoFetch: true,
+                    disableStream: true
+                }}).promise.then(pdf => {{
+                    pdfDocument = pdf;
+                    start(pdfjsRenderer);
+                }});
+            }}
         </script>
     </body>
     </html>
@@ -1,9 +1,13 @@
 import os
-from flask import Flask, render_template_string, request, send_from_directory, abort
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-import io
+from flask import Flask, render_template_string, request, send_file, abort
+import jobs
+import metadata
+import optimize
+import profiling
+import numbering
+import storage
+import uploads
+from pdf_tools import extract_pages
 
 app = Flask(__name__)
 
@@ -15,55 +19,34 @@ app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-# Function to add page numbers to the PDF
-def add_page_numbers(input_pdf_path, output_pdf_path, numbering_method, position):
-    reader = PdfReader(input_pdf_path)
-    writer = PdfWriter()
-
-    total_pages = len(reader.pages)
-
-    for i in range(total_pages):
-        page = reader.pages[i]
-        packet = io.BytesIO()
-        c = canvas.Canvas(packet, pagesize=letter)
-
-        if numbering_method == 'simple':
-            page_number = f"Page {i + 1} of {total_pages}"
-        elif numbering_method == 'detailed':
-            page_number = f"{i + 1}, "
-        else:
-            page_number = f"Page {i + 1}"
-
-        c.setFont("Helvetica", 10)
-        if position == 'left':
-            c.drawString(10, 10, page_number)
-        elif position == 'middle':
-            c.drawString(270, 10, page_number)  # Center position
-        elif position == 'right':
-            c.drawString(500, 10, page_number)
-
-        c.save()
+# Background processing for ?async=1 requests
+jobs.init_app(app)
 
-        packet.seek(0)
-        new_pdf = PdfReader(packet)
-        page.merge_page(new_pdf.pages[0])
+# Uploads streamed to memory or disk as they arrive, checked to be PDFs
+uploads.init_app(app)
 
-        writer.add_page(page)
+# Uploads and results stored by content hash
+storage.init_app(app)
 
-    with open(output_pdf_path, "wb") as output_pdf:
-        writer.write(output_pdf)
+# Optional rewrite of PDF outputs (object streams, compressed streams,
+# unreferenced objects dropped); ?optimize=<level> overrides the default
+optimize.init_app(app)
 
-# Function to extract pages from a PDF
-def extract_pages(input_pdf_path, page_numbers, output_pdf_path):
-    reader = PdfReader(input_pdf_path)
-    writer = PdfWriter()
+# Stage timings in a Server-Timing header, Prometheus metrics on /metrics and
+# (with PROFILE_REQUESTS set) cProfile output for requests sent with ?profile=1
+profiling.init_app(app)
 
-    for page_num in page_numbers:
-        if page_num < len(reader.pages):
-            writer.add_page(reader.pages[page_num])
+# Label format for each numbering method offered on the form
+NUMBERING_FORMATS = {
+    'simple': "Page {page} of {total}",
+    'detailed': "{page}, ",
+    'classic': "Page {page}",
+}
 
-    with open(output_pdf_path, "wb") as output_pdf:
-        writer.write(output_pdf)
+# Function to add page numbers to the PDF
+def add_page_numbers(input_pdf, output_pdf, numbering_method, position):
+    label_format = NUMBERING_FORMATS.get(numbering_method, NUMBERING_FORMATS['classic'])
+    numbering.add_page_numbers(input_pdf, output_pdf, label_format, position, font_size=10)
 
 # Home route with tool selection
 @app.route('/')
@@ -82,22 +65,28 @@ def page_numbering():
         if pdf_file.filename == '':
             return "No selected file"
         
-        input_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], pdf_file.filename)
-        pdf_file.save(input_pdf_path)
+        digest, input_pdf = storage.save_upload(pdf_file)
 
         numbering_method = request.form['numbering_method']
         position = request.form['position']
+        label_format = NUMBERING_FORMATS.get(numbering_method, NUMBERING_FORMATS['classic'])
 
         output_pdf_filename = f"{os.path.splitext(pdf_file.filename)[0]}_page_numbered.pdf"
-        output_pdf_path = os.path.join(app.config['OUTPUT_FOLDER'], output_pdf_filename)
+
+        if jobs.wants_job():
+            return jobs.submit(numbering.add_page_numbers, input_pdf, jobs.OUTPUT, label_format, position, 10,
+                               download_name=output_pdf_filename)
         
-        add_page_numbers(input_pdf_path, output_pdf_path, numbering_method, position)
+        output_pdf = storage.cached_result(
+            'page_numbers', [digest], {'label_format': label_format, 'position': position, 'font_size': 10}, '.pdf',
+            lambda output: add_page_numbers(input_pdf, output, numbering_method, position),
+            buffered=storage.in_memory(input_pdf))
         
         # Ensure the file exists and is valid before serving
-        if not os.path.exists(output_pdf_path):
+        if not storage.in_memory(output_pdf) and not os.path.exists(output_pdf):
             abort(404, description="File not found")
 
-        return send_from_directory(app.config['OUTPUT_FOLDER'], output_pdf_filename, as_attachment=True)
+        return send_file(output_pdf, as_attachment=True, download_name=output_pdf_filename)
     
     return render_template_string(PAGE_NUMBERING_TEMPLATE)
 
@@ -113,21 +102,33 @@ def extract_pages_route():
         if pdf_file.filename == '':
             return "No selected file"
         
-        input_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], pdf_file.filename)
-        pdf_file.save(input_pdf_path)
+        digest, input_pdf = storage.save_upload(pdf_file)
 
         page_numbers = request.form['page_numbers']
         page_numbers = list(map(int, page_numbers.split(',')))  # Convert string to list of integers
 
+        # Pages past the end are skipped; drop them up front so requests that
+        # differ only in those share a cached result
+        with profiling.stage('count'):
+            num_pages = metadata.page_count(input_pdf)
+        page_numbers = [page_num for page_num in page_numbers if page_num < num_pages]
+
         output_pdf_filename = f"{os.path.splitext(pdf_file.filename)[0]}_extracted.pdf"
-        output_pdf_path = os.path.join(app.config['OUTPUT_FOLDER'], output_pdf_filename)
-        extract_pages(input_pdf_path, page_numbers, output_pdf_path)
+
+        if jobs.wants_job():
+            return jobs.submit(extract_pages, input_pdf, page_numbers, jobs.OUTPUT,
+                               download_name=output_pdf_filename)
+
+        output_pdf = storage.cached_result(
+            'extract_pages', [digest], {'page_numbers': page_numbers}, '.pdf',
+            lambda output: extract_pages(input_pdf, page_numbers, output),
+            buffered=storage.in_memory(input_pdf))
         
         # Ensure the file exists and is valid before serving
-        if not os.path.exists(output_pdf_path):
+        if not storage.in_memory(output_pdf) and not os.path.exists(output_pdf):
             abort(404, description="File not found")
 
-        return send_from_directory(app.config['OUTPUT_FOLDER'], output_pdf_filename, as_attachment=True)
+        return send_file(output_pdf, as_attachment=True, download_name=output_pdf_filename)
 
     return render_template_string(EXTRACT_PAGES_TEMPLATE)
 
@@ -0,0 +1,454 @@
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from PyPDF2 import PdfReader, PdfWriter
+from reportlab.lib.pagesizes import A4, A5, landscape, legal, letter
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+import numbering
+import optimize
+import pdf_tools
+import profiling
+
+# Images in the synthetic corpus need Pillow
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Write a simple text-only PDF with the given number of pages
+def make_pdf(path, num_pages, lines_per_page=1):
+    c = canvas.Canvas(path, pagesize=letter)
+    for i in range(num_pages):
+        c.setFont("Helvetica", 12)
+        c.drawString(72, 720, f"Benchmark document, page {i + 1}")
+        for line in range(1, lines_per_page):
+            c.drawString(72, 720 - 14 * line, f"Line {line} of benchmark text on page {i + 1}")
+        c.showPage()
+    c.save()
+
+
+# The original page numbering path: one canvas, buffer and reader per page
+def add_page_numbers_per_page(input_pdf_path, output_pdf_path, label_format, position, font_size=10):
+    reader = PdfReader(input_pdf_path)
+    writer = PdfWriter()
+
+    total_pages = len(reader.pages)
+    x = numbering.POSITIONS[position]
+
+    for i in range(total_pages):
+        page = reader.pages[i]
+        packet = io.BytesIO()
+        c = canvas.Canvas(packet, pagesize=letter)
+        c.setFont("Helvetica", font_size)
+        c.drawString(x, 10, label_format.format(page=i + 1, total=total_pages))
+        c.save()
+
+        packet.seek(0)
+        new_pdf = PdfReader(packet)
+        page.merge_page(new_pdf.pages[0])
+
+        writer.add_page(page)
+
+    with open(output_pdf_path, "wb") as output_pdf:
+        writer.write(output_pdf)
+
+
+PAGE_NUMBERING_ENGINES = {
+    'per_page': add_page_numbers_per_page,
+    'overlay': lambda *args: numbering.add_page_numbers(*args, engine='overlay'),
+    'template': numbering.add_page_numbers,
+}
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+# Compare the page numbering engines on documents of increasing length
+def bench_page_numbers(sizes, workdir):
+    print(f"{'pages':>8} {'engine':>10} {'seconds':>10} {'pages/s':>10}")
+    for num_pages in sizes:
+        input_path = os.path.join(workdir, f"numbering_{num_pages}.pdf")
+        make_pdf(input_path, num_pages)
+        for name, engine in PAGE_NUMBERING_ENGINES.items():
+            output_path = os.path.join(workdir, f"numbering_{num_pages}_{name}.pdf")
+            seconds = timed(engine, input_path, output_path, "Page {page} of {total}", 'right')
+            print(f"{num_pages:>8} {name:>10} {seconds:>10.3f} {num_pages / seconds:>10.1f}")
+    print(f"stamp template cache: {numbering.STAMP_CACHE.stats()}")
+
+
+# Worker counts to try: powers of two up to the number of CPUs
+def worker_counts():
+    cpus = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cpus:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cpus:
+        counts.append(cpus)
+    return counts
+
+
+# Speedup of sharded text extraction over the serial path, per worker count
+def bench_text_extraction(sizes, workdir):
+    print(f"{'pages':>8} {'workers':>8} {'seconds':>10} {'speedup':>8}")
+    for num_pages in sizes:
+        input_path = os.path.join(workdir, f"text_{num_pages}.pdf")
+        make_pdf(input_path, num_pages, lines_per_page=40)
+        serial = None
+        for workers in worker_counts():
+            seconds = timed(pdf_tools.extract_text, input_path, workers)
+            serial = serial or seconds
+            print(f"{num_pages:>8} {workers:>8} {seconds:>10.3f} {serial / seconds:>8.2f}")
+
+
+# Write a PDF of roughly size_bytes by hand: one incompressible image of
+# page_bytes per page, so files in the gigabytes can be built quickly
+def make_large_pdf(path, size_bytes, page_bytes=8 * 1024 * 1024):
+    num_pages = max(1, size_bytes // page_bytes)
+    block = os.urandom(1024 * 1024)
+    image_data = (block * (page_bytes // len(block) + 1))[:page_bytes]
+
+    offsets = []
+    with open(path, 'wb') as pdf:
+        def start_object(number):
+            offsets.append(pdf.tell())
+            pdf.write(f"{number} 0 obj\n".encode())
+
+        pdf.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        start_object(1)
+        pdf.write(b"<< /Type /Catalog /Pages 2 0 R >>\nendobj\n")
+        kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(num_pages))
+        start_object(2)
+        pdf.write(f"<< /Type /Pages /Kids [{kids}] /Count {num_pages} >>\nendobj\n".encode())
+        for i in range(num_pages):
+            page, image = 3 + 2 * i, 4 + 2 * i
+            start_object(page)
+            pdf.write(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                      f"/Resources << /XObject << /Im0 {image} 0 R >> >> >>\nendobj\n".encode())
+            start_object(image)
+            pdf.write(f"<< /Type /XObject /Subtype /Image /Width {page_bytes} /Height 1 "
+                      f"/ColorSpace /DeviceGray /BitsPerComponent 8 /Length {page_bytes} >>\n"
+                      f"stream\n".encode())
+            pdf.write(image_data)
+            pdf.write(b"\nendstream\nendobj\n")
+
+        xref = pdf.tell()
+        pdf.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            pdf.write(f"{offset:010d} 00000 n \n".encode())
+        pdf.write(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\n"
+                  f"startxref\n{xref}\n%%EOF\n".encode())
+
+
+# Read syscalls and bytes read so far by this process (Linux only)
+def read_counters():
+    try:
+        with open('/proc/self/io') as io_stats:
+            fields = dict(line.split(': ') for line in io_stats.read().splitlines())
+        return int(fields['syscr']), int(fields['rchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+# Parse the document and pull every page's image data through the reader
+def read_all_streams(path, mmap_threshold):
+    with pdf_tools.open_source(path, mmap_threshold) as pdf_file:
+        reader = PdfReader(pdf_file)
+        for page in reader.pages:
+            image = page['/Resources']['/XObject'].raw_get('/Im0')
+            image.get_object().get_data()
+            reader.resolved_objects.pop((image.generation, image.idnum), None)
+
+
+# Wall time and read syscalls with a regular file object versus a memory map
+def bench_mmap(sizes, workdir):
+    print(f"{'MB':>8} {'mode':>6} {'seconds':>10} {'read calls':>12} {'bytes read':>14}")
+    for size_mb in sizes:
+        input_path = os.path.join(workdir, f"large_{size_mb}.pdf")
+        make_large_pdf(input_path, size_mb * 1024 * 1024)
+        for mode, threshold in (('file', float('inf')), ('mmap', 0)):
+            calls_before, bytes_before = read_counters()
+            seconds = timed(read_all_streams, input_path, threshold)
+            calls_after, bytes_after = read_counters()
+            if calls_before is None:
+                calls, read_bytes = 'n/a', 'n/a'
+            else:
+                calls, read_bytes = calls_after - calls_before, bytes_after - bytes_before
+            print(f"{size_mb:>8} {mode:>6} {seconds:>10.3f} {calls:>12} {read_bytes:>14}")
+        os.remove(input_path)
+
+
+# Size and time cost of each optimization level on a page-numbered document,
+# as the tools' PdfWriter outputs (uncompressed merged content streams)
+def bench_optimize(sizes, workdir):
+    print(f"{'pages':>8} {'level':>6} {'seconds':>10} {'bytes':>12} {'saved':>8}")
+    for num_pages in sizes:
+        input_path = os.path.join(workdir, f"optimize_{num_pages}.pdf")
+        output_path = os.path.join(workdir, f"optimize_{num_pages}_numbered.pdf")
+        make_pdf(input_path, num_pages, lines_per_page=40)
+        numbering.add_page_numbers(input_path, output_path, "Page {page} of {total}", 'right')
+        original = os.path.getsize(output_path)
+        print(f"{num_pages:>8} {0:>6} {0:>10.3f} {original:>12} {0:>7.1f}%")
+        for level in sorted(optimize.LEVELS):
+            stats = optimize.optimize_pdf(output_path, os.path.join(workdir, f"optimize_{level}.pdf"), level)
+            saved = 100 * (1 - stats['bytes_out'] / original)
+            print(f"{num_pages:>8} {level:>6} {stats['seconds']:>10.3f} {stats['bytes_out']:>12} {saved:>7.1f}%")
+
+
+# Kinds of document in the route benchmark's corpus: page sizes (cycled
+# through page by page), lines of text per page, font (Vera is a TrueType
+# font shipped with reportlab, so it gets embedded) and an image every
+# image_every pages (0 for none)
+CORPUS_KINDS = {
+    'text': {'sizes': [letter], 'lines': 45, 'font': 'Helvetica', 'image_every': 0},
+    'fonts': {'sizes': [A4], 'lines': 45, 'font': 'Vera', 'image_every': 0},
+    'images': {'sizes': [landscape(letter)], 'lines': 4, 'font': 'Helvetica', 'image_every': 1},
+    'mixed': {'sizes': [letter, A4, legal, landscape(A5)], 'lines': 20, 'font': 'Vera', 'image_every': 3},
+}
+
+WORDS = ("invoice total amount page report summary account balance payment date "
+         "customer order item quantity price tax shipping note reference number").split()
+
+
+# Write one synthetic document; rng makes its text and images reproducible,
+# and an invariant canvas leaves out the creation date and random file ID
+def make_corpus_pdf(path, num_pages, kind, rng):
+    if 'Vera' not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont('Vera', 'Vera.ttf'))
+    c = canvas.Canvas(path, invariant=1)
+    for i in range(num_pages):
+        width, height = kind['sizes'][i % len(kind['sizes'])]
+        c.setPageSize((width, height))
+        c.setFont(kind['font'], 10)
+        for line in range(kind['lines']):
+            y = height - 72 - 12 * line
+            if y < 36:
+                break
+            c.drawString(72, y, " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))))
+        if kind['image_every'] and Image is not None and i % kind['image_every'] == 0:
+            # Noise compresses like a photo; a different image on every page
+            side = rng.choice((256, 512, 1024))
+            image = Image.frombytes('L', (side, side), rng.randbytes(side * side)).convert('RGB')
+            c.drawImage(ImageReader(image), 72, 72, width / 3, width / 3)
+        c.drawString(width - 120, 20, f"{i + 1} / {num_pages}")
+        c.showPage()
+    c.save()
+
+
+# Every kind of document at every page count, as a list of
+# {'name', 'path', 'pages', 'kind', 'bytes'}; the same seed gives the same files
+def make_corpus(workdir, page_counts, seed=0):
+    corpus = []
+    for num_pages in page_counts:
+        for kind_name, kind in CORPUS_KINDS.items():
+            path = os.path.join(workdir, f"corpus_{kind_name}_{num_pages}.pdf")
+            make_corpus_pdf(path, num_pages, kind, random.Random(f"{seed}-{kind_name}-{num_pages}"))
+            corpus.append({'name': f"{kind_name}_{num_pages}", 'path': path, 'pages': num_pages,
+                           'kind': kind_name, 'bytes': os.path.getsize(path)})
+    return corpus
+
+
+# Routes driven by the route benchmark: the app module serving it, its path,
+# and the form fields (without the upload) for a document of n pages
+ROUTES = {
+    'add_page_numbers': ('worked', '/add_page_numbers', lambda n: {'numbering_method': 'simple'}),
+    'splitter': ('main', '/splitter', lambda n: {'start_page': 1, 'end_page': max(1, n // 2)}),
+    'merger': ('main', '/merger', lambda n: {}),
+    'rotate': ('main', '/rotate', lambda n: {'degree': 90}),
+    'extract_text': ('main', '/extract_text', lambda n: {}),
+    'remove_page': ('main', '/remove_page', lambda n: {'page_number': 1}),
+    'compress': ('main', '/compress', lambda n: {'dpi': 100}),
+}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _server_timing(header):
+    stages = {}
+    for entry in filter(None, (part.strip() for part in (header or "").split(","))):
+        name, _, duration = entry.partition(";dur=")
+        stages[name] = float(duration) / 1000 if duration else 0.0
+    return stages
+
+
+# POST one document to a route; the merger gets two copies of it
+def _post(client, path, doc, fields):
+    with open(doc['path'], 'rb') as pdf_file:
+        data = pdf_file.read()
+    if path == '/merger':
+        fields = dict(fields, pdf_files=[(io.BytesIO(data), 'a.pdf'), (io.BytesIO(data), 'b.pdf')])
+    else:
+        fields = dict(fields, pdf_file=(io.BytesIO(data), 'input.pdf'))
+    response = client.post(path, data=fields, content_type='multipart/form-data')
+    response.get_data()
+    response.close()
+    return response
+
+
+# IN_MEMORY_THRESHOLD that sends an upload of size bytes down each path
+UPLOAD_PATHS = {
+    'disk': lambda size: 0,
+    # The merger posts two copies, which share one budget
+    'memory': lambda size: 2 * size,
+}
+
+
+# Forget everything an app has kept about earlier requests: stored uploads
+# and cached results
+def _reset(app):
+    store = app.extensions['store']
+    for folder in (store.upload_dir, store.result_dir):
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder, exist_ok=True)
+
+
+# Throughput, p50/p99 latency, median stage timings (from Server-Timing) and
+# peak RSS of each route on each corpus document, through Flask's test
+# client, once per upload path (see UPLOAD_PATHS). Stored uploads and result
+# caches are reset before every request so each one pays the cost of a
+# first request. Results are written as JSON to output, and compared with an
+# earlier results file when compare is given.
+def bench_routes(sizes, workdir, iterations=5, output=None, seed=0, compare=None, uploads=tuple(UPLOAD_PATHS)):
+    corpus = make_corpus(workdir, sizes, seed)
+
+    # The apps create their upload and output folders in the working
+    # directory when imported
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import main
+        import worked
+        apps = {'main': main.app, 'worked': worked.app}
+        results = []
+        print(f"{'route':>16} {'document':>12} {'upload':>7} {'req/s':>8} {'pages/s':>9} {'p50 ms':>9} "
+              f"{'p99 ms':>9} {'peak MB':>8}")
+        for route, (app_name, path, fields) in ROUTES.items():
+            app = apps[app_name]
+            client = app.test_client()
+            for doc in corpus:
+                for upload in uploads:
+                    app.config['IN_MEMORY_THRESHOLD'] = UPLOAD_PATHS[upload](doc['bytes'])
+                    latencies = []
+                    stages = {}
+                    peak = 0
+                    for _ in range(iterations):
+                        _reset(app)
+                        profiling.reset_peak_rss()
+                        started = time.perf_counter()
+                        response = _post(client, path, doc, fields(doc['pages']))
+                        latencies.append(time.perf_counter() - started)
+                        peak = max(peak, profiling.peak_rss())
+                        if response.status_code != 200:
+                            raise RuntimeError(f"{path} answered {response.status_code} for {doc['name']}")
+                        for name, seconds in _server_timing(response.headers.get('Server-Timing')).items():
+                            stages.setdefault(name, []).append(seconds)
+
+                    total = sum(latencies)
+                    result = {
+                        'route': route,
+                        'document': doc['name'],
+                        'upload': upload,
+                        'pages': doc['pages'],
+                        'input_bytes': doc['bytes'],
+                        'iterations': iterations,
+                        'requests_per_second': iterations / total,
+                        'pages_per_second': iterations * doc['pages'] / total,
+                        'p50_seconds': percentile(latencies, 0.5),
+                        'p99_seconds': percentile(latencies, 0.99),
+                        'stages': {name: percentile(values, 0.5) for name, values in stages.items()},
+                        'peak_rss_bytes': peak,
+                    }
+                    results.append(result)
+                    print(f"{route:>16} {doc['name']:>12} {upload:>7} {result['requests_per_second']:>8.1f} "
+                          f"{result['pages_per_second']:>9.1f} {result['p50_seconds'] * 1000:>9.1f} "
+                          f"{result['p99_seconds'] * 1000:>9.1f} {peak / 2 ** 20:>8.1f}")
+    finally:
+        os.chdir(cwd)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'seed': seed,
+        'iterations': iterations,
+        'uploads': list(uploads),
+        'corpus': [{key: doc[key] for key in ('name', 'kind', 'pages', 'bytes')} for doc in corpus],
+        'results': results,
+    }
+    if output:
+        with open(output, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"results written to {output}")
+    if compare:
+        compare_results(compare, report)
+    return report
+
+
+# p50 latency of each (route, document, upload path) in report against an
+# earlier run; results from before upload paths were reported count as disk
+def compare_results(baseline_path, report):
+    with open(baseline_path, encoding='utf-8') as baseline_file:
+        baseline = {(r['route'], r['document'], r.get('upload', 'disk')): r
+                    for r in json.load(baseline_file)['results']}
+    print(f"{'route':>16} {'document':>12} {'upload':>7} {'p50 before':>11} {'p50 after':>10} {'change':>8}")
+    for result in report['results']:
+        before = baseline.get((result['route'], result['document'], result['upload']))
+        if before is None:
+            continue
+        change = 100 * (result['p50_seconds'] / before['p50_seconds'] - 1)
+        print(f"{result['route']:>16} {result['document']:>12} {result['upload']:>7} "
+              f"{before['p50_seconds'] * 1000:>11.1f} {result['p50_seconds'] * 1000:>10.1f} {change:>+7.1f}%")
+
+
+# Benchmark function and its default sizes (pages, or megabytes for mmap)
+BENCHMARKS = {
+    'page_numbers': (bench_page_numbers, '10,500,5000'),
+    'text_extraction': (bench_text_extraction, '100,1500'),
+    'mmap': (bench_mmap, '50,500,2048'),
+    'optimize': (bench_optimize, '10,500,5000'),
+    'routes': (bench_routes, '10,100'),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the PDF tools")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--sizes',
+                        help="comma separated page counts, or megabytes for mmap "
+                             "(default depends on the benchmark)")
+    parser.add_argument('--iterations', type=int, default=5, help="requests per route and document (routes)")
+    parser.add_argument('--seed', type=int, default=0, help="corpus seed (routes)")
+    parser.add_argument('--output', help="write results as JSON to this file (routes)")
+    parser.add_argument('--compare', help="compare with an earlier JSON results file (routes)")
+    parser.add_argument('--uploads', default=','.join(UPLOAD_PATHS),
+                        help="comma separated upload paths to measure: disk, memory (routes)")
+    args = parser.parse_args()
+
+    bench, default_sizes = BENCHMARKS[args.benchmark]
+    sizes = [int(size) for size in (args.sizes or default_sizes).split(',')]
+    options = {}
+    if bench is bench_routes:
+        options = {'iterations': args.iterations, 'output': args.output and os.path.abspath(args.output),
+                   'seed': args.seed, 'compare': args.compare, 'uploads': args.uploads.split(',')}
+    with tempfile.TemporaryDirectory() as workdir:
+        bench(sizes, workdir, **options)
@@ -0,0 +1,352 @@
+import hashlib
+import io
+import math
+import os
+import zlib
+
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.errors import PdfReadError
+from PyPDF2.generic import (ArrayObject, BooleanObject, ContentStream, DictionaryObject, IndirectObject,
+                            NameObject, NumberObject)
+
+import pools
+import profiling
+from pdf_tools import is_path, open_output, open_source
+
+# Image work needs Pillow; without it the compress tool is unavailable
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+MODES = ('jpeg', 'bilevel')
+
+IDENTITY = (1, 0, 0, 1, 0, 0)
+
+# Images are only resampled when that removes at least this share of their
+# width, so near-target images aren't put through a lossy pass for nothing
+MIN_SHRINK = 0.1
+
+# Filters whose output get_data() decodes to raw samples
+RAW_FILTERS = ('/FlateDecode', '/LZWDecode', '/ASCII85Decode', '/ASCIIHexDecode', '/RunLengthDecode')
+
+# Files smaller than this have their images encoded in the calling process
+# even when workers are configured; every worker parses the file again, which
+# costs more than encoding a small file's images
+MIN_PARALLEL_BYTES = 4 * 1024 * 1024
+
+
+def available():
+    return Image is not None
+
+
+def _filters(image):
+    filters = image.get('/Filter')
+    if filters is None:
+        return []
+    if isinstance(filters, ArrayObject):
+        return list(filters)
+    return [filters]
+
+
+def _multiply(m, n):
+    a, b, c, d, e, f = m
+    A, B, C, D, E, F = n
+    return (a * A + b * C, a * B + b * D, c * A + d * C, c * B + d * D,
+            e * A + f * C + E, e * B + f * D + F)
+
+
+# Walk a content stream, recording the largest size in points each image
+# XObject is drawn at; form XObjects are followed with their own matrix and
+# resources
+def _scan(reader, content, resources, ctm, sizes, forms):
+    resources = resources.get_object() if resources is not None else DictionaryObject()
+    xobjects = resources.get('/XObject')
+    xobjects = xobjects.get_object() if xobjects is not None else DictionaryObject()
+
+    stack = []
+    for operands, operator in ContentStream(content, reader).operations:
+        if operator == b'q':
+            stack.append(ctm)
+        elif operator == b'Q' and stack:
+            ctm = stack.pop()
+        elif operator == b'cm' and len(operands) == 6:
+            ctm = _multiply([float(value) for value in operands], ctm)
+        elif operator == b'Do' and operands and operands[0] in xobjects:
+            ref = xobjects.raw_get(operands[0])
+            if not isinstance(ref, IndirectObject):
+                continue
+            key = (ref.idnum, ref.generation)
+            xobject = ref.get_object()
+            subtype = xobject.get('/Subtype')
+            if subtype == '/Image':
+                width, height = sizes.get(key, (0.0, 0.0))
+                sizes[key] = (max(width, math.hypot(ctm[0], ctm[1])), max(height, math.hypot(ctm[2], ctm[3])))
+            elif subtype == '/Form' and key not in forms:
+                matrix = [float(value) for value in xobject.get('/Matrix', IDENTITY)]
+                _scan(reader, xobject, xobject.get('/Resources', resources), _multiply(matrix, ctm), sizes,
+                      forms | {key})
+
+
+# Largest size in points each image on a page is drawn at, as
+# {(idnum, generation): (width, height)}
+def image_placements(reader, page):
+    sizes = {}
+    if '/Contents' in page:
+        _scan(reader, page['/Contents'].get_object(), page.get('/Resources'), IDENTITY, sizes, frozenset())
+    return sizes
+
+
+# Number of colour components of the image colour spaces that can be
+# re-encoded as they are: device gray and RGB, and ICC profiles of either
+def _components(color_space):
+    color_space = color_space.get_object() if color_space is not None else None
+    if color_space == '/DeviceGray':
+        return 1
+    if color_space == '/DeviceRGB':
+        return 3
+    if isinstance(color_space, ArrayObject) and len(color_space) == 2 and color_space[0] == '/ICCBased':
+        components = color_space[1].get_object().get('/N')
+        return components if components in (1, 3) else None
+    return None
+
+
+# Pillow image of an image XObject, or None for the kinds that are left
+# alone: masks, decode arrays, colour keys and other colour spaces, and
+# encodings other than JPEG and plain 8-bit samples
+def _decode(image):
+    if image.get('/ImageMask') or '/Mask' in image or '/Decode' in image:
+        return None
+    components = _components(image.get('/ColorSpace'))
+    if components is None:
+        return None
+
+    filters = _filters(image)
+    if filters == ['/DCTDecode']:
+        decoded = Image.open(io.BytesIO(image._data))
+        return decoded if decoded.mode in ('L', 'RGB') else None
+    if any(name not in RAW_FILTERS for name in filters) or image.get('/BitsPerComponent') != 8:
+        return None
+    mode = 'L' if components == 1 else 'RGB'
+    return Image.frombytes(mode, (image['/Width'], image['/Height']), image.get_data())
+
+
+def _encode_jpeg(decoded, quality):
+    buffer = io.BytesIO()
+    decoded.save(buffer, 'JPEG', quality=quality, optimize=True)
+    return {'data': buffer.getvalue(), 'filter': '/DCTDecode', 'bits': 8, 'gray': False, 'parms': None}
+
+
+def _encode_flate(decoded):
+    return {'data': zlib.compress(decoded.tobytes(), 9), 'filter': '/FlateDecode', 'bits': 8, 'gray': False,
+            'parms': None}
+
+
+# One bit per pixel, thresholded at mid-gray: CCITT Group 4 (the fax
+# encoding scanned text is usually stored in) when Pillow has libtiff, else
+# Flate-compressed bits
+def _encode_bilevel(decoded):
+    bits = decoded.convert('L').convert('1', dither=Image.Dither.NONE)
+    if not features.check('libtiff'):
+        return {'data': zlib.compress(bits.tobytes(), 9), 'filter': '/FlateDecode', 'bits': 1,
+                'gray': True, 'parms': None}
+
+    buffer = io.BytesIO()
+    bits.save(buffer, 'TIFF', compression='group4', tiffinfo={278: bits.height})
+    tiff = Image.open(buffer)
+    offset, length = tiff.tag_v2[273][0], tiff.tag_v2[279][0]
+    # The encoder codes runs of 0 bits as white; with Pillow's min-is-black
+    # photometric those are black pixels
+    parms = {'/K': -1, '/Columns': bits.width, '/Rows': bits.height, '/BlackIs1': tiff.tag_v2[262] == 1}
+    return {'data': buffer.getvalue()[offset:offset + length], 'filter': '/CCITTFaxDecode', 'bits': 1,
+            'gray': True, 'parms': parms}
+
+
+# New encoding of one image at (width, height) pixels, or None when the
+# image can't be decoded or the result isn't smaller. In jpeg mode a
+# resampled image is also tried losslessly, which wins for flat artwork.
+def encode_image(image, size, mode, quality):
+    try:
+        return _encode_image(image, size, mode, quality)
+    except (OSError, ValueError, EOFError, zlib.error, PdfReadError, Image.DecompressionBombError):
+        # A corrupt or unreadable stream keeps its original encoding
+        return None
+
+
+def _encode_image(image, size, mode, quality):
+    decoded = _decode(image)
+    if decoded is None:
+        return None
+    if mode == 'bilevel':
+        candidates = [_encode_bilevel(decoded.resize(size, Image.LANCZOS))]
+    elif size != decoded.size:
+        decoded = decoded.resize(size, Image.LANCZOS)
+        candidates = [_encode_jpeg(decoded, quality), _encode_flate(decoded)]
+    elif _filters(image) != ['/DCTDecode']:
+        candidates = [_encode_jpeg(decoded, quality)]
+    else:
+        return None
+
+    result = min(candidates, key=lambda candidate: len(candidate['data']))
+    if len(result['data']) >= len(image._data):
+        return None
+    result['size'] = size
+    return result
+
+
+def _encode_images(reader, tasks, mode, quality):
+    results = []
+    for idnum, generation, size in tasks:
+        image = reader.get_object(IndirectObject(idnum, generation, reader))
+        results.append(((idnum, generation), encode_image(image, size, mode, quality)))
+    return results
+
+
+# Worker side: open (or map) the file by path once and encode a batch of images
+def _encode_batch(pdf_path, tasks, mode, quality):
+    with open_source(pdf_path) as pdf_file:
+        return _encode_images(PdfReader(pdf_file), tasks, mode, quality)
+
+
+# True when the images are worth encoding in worker processes
+def _parallel(pdf_source, tasks, workers):
+    return workers > 1 and len(tasks) > 1 and is_path(pdf_source) and \
+        os.path.getsize(pdf_source) >= MIN_PARALLEL_BYTES
+
+
+# New encodings of the images, as ((idnum, generation), result) pairs. Large
+# files are encoded by the shared pool, each worker taking one run of
+# consecutive images so it parses the file once; everything else is encoded
+# here from the reader already open.
+def _encode_all(pdf_source, reader, tasks, mode, quality, workers):
+    if not _parallel(pdf_source, tasks, workers):
+        return _encode_images(reader, tasks, mode, quality)
+
+    size = math.ceil(len(tasks) / workers)
+    batches = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+    results = []
+    for batch in pools.executor(workers).map(_encode_batch, [pdf_source] * len(batches), batches,
+                                              [mode] * len(batches), [quality] * len(batches)):
+        results.extend(batch)
+    return results
+
+
+# Pixel size an image should have to be drawn at dpi when its largest
+# placement is (width, height) points; the original size when it is already
+# within MIN_SHRINK of that
+def target_size(image, placement, dpi):
+    width, height = image['/Width'], image['/Height']
+    scale = max(placement[0] * dpi / 72 / width, placement[1] * dpi / 72 / height)
+    if scale > 1 - MIN_SHRINK:
+        return width, height
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _digest(image):
+    sha256 = hashlib.sha256(image._data)
+    buffer = io.BytesIO()
+    DictionaryObject({key: value for key, value in image.items() if key != '/Length'}).write_to_stream(buffer, None)
+    sha256.update(buffer.getvalue())
+    return sha256.hexdigest()
+
+
+# Point every image reference in a page's resources (and those of its form
+# XObjects) that has a duplicate at the first copy
+def _reuse_duplicates(resources, canonical, seen):
+    resources = resources.get_object() if resources is not None else None
+    xobjects = resources.get('/XObject') if resources is not None else None
+    if xobjects is None:
+        return
+    xobjects = xobjects.get_object()
+    for name in list(xobjects):
+        ref = xobjects.raw_get(name)
+        if not isinstance(ref, IndirectObject):
+            continue
+        key = (ref.idnum, ref.generation)
+        if key in canonical:
+            xobjects[NameObject(name)] = canonical[key]
+        elif key not in seen and ref.get_object().get('/Subtype') == '/Form':
+            seen.add(key)
+            _reuse_duplicates(ref.get_object().get('/Resources'), canonical, seen)
+
+
+def _apply(image, result):
+    image._data = result['data']
+    if hasattr(image, 'decoded_self'):
+        image.decoded_self = None
+    image.pop('/DecodeParms', None)
+    image[NameObject('/Width')] = NumberObject(result['size'][0])
+    image[NameObject('/Height')] = NumberObject(result['size'][1])
+    image[NameObject('/BitsPerComponent')] = NumberObject(result['bits'])
+    image[NameObject('/Filter')] = NameObject(result['filter'])
+    if result['gray']:
+        image[NameObject('/ColorSpace')] = NameObject('/DeviceGray')
+    if result['parms']:
+        image[NameObject('/DecodeParms')] = DictionaryObject({
+            NameObject(key): BooleanObject(value) if isinstance(value, bool) else NumberObject(value)
+            for key, value in result['parms'].items()})
+
+
+# Downsample every image drawn above dpi to dpi and re-encode images as JPEG
+# (at quality) or as bilevel, keeping the old encoding wherever the new one
+# isn't smaller; byte-identical images are written once. Images are encoded
+# in worker processes when workers > 1 (None: one per CPU) and the source is
+# a path of at least MIN_PARALLEL_BYTES. Returns counts of images, duplicates and re-encoded
+# images, and the bytes of image data saved.
+def compress_pdf(pdf_source, output, dpi=150, mode='jpeg', quality=75, workers=1):
+    if mode not in MODES:
+        raise ValueError(f"unknown compression mode {mode!r}")
+    workers = workers or os.cpu_count() or 1
+    stats = {'images': 0, 'duplicates': 0, 'recompressed': 0, 'bytes_saved': 0}
+    with open_source(pdf_source) as pdf_file:
+        with profiling.stage('parse'):
+            reader = PdfReader(pdf_file)
+            profiling.count('pages', len(reader.pages))
+
+        # Each distinct image is encoded once, with the page it first appears
+        # on, at the size its largest placement anywhere needs
+        with profiling.stage('scan'):
+            placements = {}
+            canonical = {}
+            first_seen = {}
+            page_tasks = []
+            for page in reader.pages:
+                keys = []
+                for key, size in image_placements(reader, page).items():
+                    if key in canonical:
+                        key = (canonical[key].idnum, canonical[key].generation)
+                    elif key not in placements:
+                        digest = _digest(reader.get_object(IndirectObject(*key, reader)))
+                        stats['images'] += 1
+                        if digest in first_seen:
+                            canonical[key] = IndirectObject(*first_seen[digest], reader)
+                            stats['duplicates'] += 1
+                            stats['bytes_saved'] += len(reader.get_object(IndirectObject(*key, reader))._data)
+                            key = first_seen[digest]
+                        else:
+                            first_seen[digest] = key
+                            keys.append(key)
+                    old = placements.get(key, (0.0, 0.0))
+                    placements[key] = (max(old[0], size[0]), max(old[1], size[1]))
+                page_tasks.append(keys)
+                _reuse_duplicates(page.get('/Resources'), canonical, set())
+
+        tasks = [(*key, target_size(reader.get_object(IndirectObject(*key, reader)), placements[key], dpi))
+                 for keys in page_tasks for key in keys]
+        with profiling.stage('encode'):
+            results = _encode_all(pdf_source, reader, tasks, mode, quality, workers)
+
+        for key, result in results:
+            if result is not None:
+                image = reader.get_object(IndirectObject(*key, reader))
+                stats['bytes_saved'] += len(image._data) - len(result['data'])
+                stats['recompressed'] += 1
+                _apply(image, result)
+
+        writer = PdfWriter()
+        with profiling.stage('add_page'):
+            for page in reader.pages:
+                writer.add_page(page)
+        with profiling.stage('write'), open_output(output) as output_file:
+            writer.write(output_file)
+    return stats
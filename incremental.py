@@ -0,0 +1,124 @@
+import io
+import re
+import shutil
+
+from PyPDF2.errors import PdfReadError
+from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject, NumberObject
+
+from pdf_writing import Output, serialize, write_xref_stream, write_xref_table
+
+# Bytes at the end of a file searched for the startxref keyword
+TAIL_SIZE = 2048
+
+XREF_STREAM_HEAD = re.compile(rb"\s*\d+\s+\d+\s+obj")
+
+
+# Offset of the file's last cross-reference section and whether it is an xref
+# stream (PDF 1.5) rather than a classic table; None when the startxref
+# pointer is missing or doesn't point at either, as in damaged files
+def last_xref(pdf_file):
+    pdf_file.seek(0, io.SEEK_END)
+    size = pdf_file.tell()
+    pdf_file.seek(max(0, size - TAIL_SIZE))
+    tail = pdf_file.read()
+    index = tail.rfind(b"startxref")
+    if index < 0:
+        return None
+    try:
+        offset = int(tail[index + len(b"startxref"):].split()[0])
+    except (IndexError, ValueError):
+        return None
+
+    pdf_file.seek(offset)
+    head = pdf_file.read(32)
+    if head.lstrip().startswith(b"xref"):
+        return offset, False
+    if XREF_STREAM_HEAD.match(head):
+        return offset, True
+    return None
+
+
+# True when changes to the reader's document can be appended as an
+# incremental update; encrypted files would need every new string and
+# stream encrypted, and damaged cross-reference data is better rewritten
+def can_update(reader, pdf_file):
+    return not reader.is_encrypted and last_xref(pdf_file) is not None
+
+
+def _object_size(reader):
+    numbers = [idnum for entries in reader.xref.values() for idnum in entries]
+    numbers.extend(reader.xref_objStm)
+    size = int(reader.trailer.get('/Size', 0))
+    return max([size] + [idnum + 1 for idnum in numbers])
+
+
+# The /Pages nodes from the root down to page index (0-based), as
+# (reference, node) pairs, and the page's reference; descends by /Count so
+# only the nodes on the way to the page are resolved
+def page_path(reader, index):
+    ref = reader.trailer['/Root'].raw_get('/Pages')
+    node = ref.get_object()
+    if not 0 <= index < node.get('/Count', 0):
+        raise IndexError(f"page index {index} out of range")
+
+    path = []
+    while True:
+        path.append((ref, node))
+        for kid in node['/Kids']:
+            kid_node = kid.get_object()
+            is_page = kid_node.get('/Type') == '/Page' or '/Kids' not in kid_node
+            count = 1 if is_page else kid_node.get('/Count', 0)
+            if index < count:
+                break
+            index -= count
+        else:
+            raise PdfReadError("page tree /Count does not match its kids")
+        if is_page:
+            return path, kid
+        ref, node = kid, kid_node
+
+
+# New versions of the page tree nodes that drop page index (0-based): the
+# parent's /Kids without it and one less in every /Count up to the root.
+# The page object itself is left in the file, unreferenced.
+def remove_page_updates(reader, index):
+    path, page_ref = page_path(reader, index)
+    updates = {}
+    for ref, node in path:
+        node[NameObject('/Count')] = NumberObject(node.get('/Count', 0) - 1)
+        updates[(ref.idnum, ref.generation)] = node
+
+    ref, parent = path[-1]
+    parent[NameObject('/Kids')] = ArrayObject(kid for kid in parent['/Kids'] if kid != page_ref)
+    return updates
+
+
+# Copy the original file to output and append new versions of the given
+# objects ({(idnum, generation): object}) with a cross-reference section
+# whose /Prev points at the original one, in the same form (table or
+# stream) as the original. Nothing before the update is rewritten.
+def append_update(pdf_file, reader, objects, output_file):
+    prev, is_stream = last_xref(pdf_file)
+    pdf_file.seek(0)
+    shutil.copyfileobj(pdf_file, output_file)
+    position = output_file.tell()
+    pdf_file.seek(-1, io.SEEK_END)
+    if pdf_file.read(1) not in b"\r\n":
+        output_file.write(b"\n")
+        position += 1
+
+    out = Output(output_file, position)
+    entries = {}
+    for (idnum, generation), obj in sorted(objects.items()):
+        entries[idnum] = out.write_object(idnum, serialize(obj), generation)
+
+    trailer = DictionaryObject()
+    for key in ('/Root', '/Info', '/ID'):
+        if key in reader.trailer:
+            trailer[NameObject(key)] = reader.trailer.raw_get(key)
+    trailer[NameObject('/Prev')] = NumberObject(prev)
+
+    if is_stream:
+        write_xref_stream(out, entries, _object_size(reader), trailer, update=True)
+    else:
+        write_xref_table(out, entries, _object_size(reader), trailer, update=True)
@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import Blueprint, abort, current_app, jsonify, request, send_file, url_for
+
+import optimize
+
+blueprint = Blueprint('jobs', __name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+# Placeholder in a job's arguments for the path its output should be written to
+OUTPUT = object()
+
+
+# One unit of background work and where its output will be written
+class Job:
+    def __init__(self, job_id, future, output_path, download_name):
+        self.id = job_id
+        self.future = future
+        self.output_path = output_path
+        self.download_name = download_name
+        self.created = time.time()
+
+    @property
+    def status(self):
+        if self.future.running():
+            return 'running'
+        if not self.future.done():
+            return 'queued'
+        if self.future.cancelled() or self.future.exception() is not None:
+            return 'failed'
+        return 'done'
+
+    def to_dict(self):
+        info = {'job_id': self.id, 'status': self.status, 'created': self.created}
+        if info['status'] == 'failed' and not self.future.cancelled():
+            info['error'] = str(self.future.exception())
+        return info
+
+
+# Bounded process pool that runs PDF work off the request thread
+class JobQueue:
+    def __init__(self, output_folder, max_workers=None, max_queued=16, max_history=1000):
+        self.output_folder = os.path.abspath(output_folder)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queued = max_queued
+        self.max_history = max_history
+        self._executor = None
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _finished(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    # Drop the oldest finished jobs (and their outputs) beyond max_history
+    def _trim(self):
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.max_history:
+                break
+            job = self._jobs[job_id]
+            if job.future.done():
+                del self._jobs[job_id]
+                if os.path.exists(job.output_path):
+                    os.remove(job.output_path)
+
+    # Queue func(*args) with OUTPUT replaced by the job's output path;
+    # raise QueueFull when every worker and queue slot is taken
+    def submit(self, func, *args, download_name='output.pdf'):
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queued:
+                raise QueueFull()
+            if self._executor is None:
+                os.makedirs(self.output_folder, exist_ok=True)
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+            job_id = uuid.uuid4().hex
+            extension = os.path.splitext(download_name)[1]
+            output_path = os.path.join(self.output_folder, f"{job_id}{extension}")
+            args = [output_path if arg is OUTPUT else arg for arg in args]
+            future = self._executor.submit(func, *args)
+            self._pending += 1
+            self._jobs[job_id] = Job(job_id, future, output_path, download_name)
+            self._trim()
+
+        future.add_done_callback(self._finished)
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Attach a job queue and the status/download routes to an app
+def init_app(app):
+    output_folder = app.config.get('OUTPUT_FOLDER', app.config['UPLOAD_FOLDER'])
+    app.config.setdefault('JOB_FOLDER', os.path.join(output_folder, 'jobs'))
+    app.config.setdefault('JOB_WORKERS', os.cpu_count() or 1)
+    app.config.setdefault('JOB_QUEUE_DEPTH', 16)
+
+    app.extensions['jobs'] = JobQueue(
+        app.config['JOB_FOLDER'],
+        max_workers=app.config['JOB_WORKERS'],
+        max_queued=app.config['JOB_QUEUE_DEPTH'],
+    )
+    app.register_blueprint(blueprint)
+
+
+# The client asked for background processing with ?async=1 or an async form field
+def wants_job():
+    return request.values.get('async', '').lower() in ('1', 'true', 'yes', 'on')
+
+
+# Queue work for the current app and answer 202 with the job id, or 429 when
+# full; PDF outputs are optimized in the worker when a level is asked for
+def submit(func, *args, download_name='output.pdf'):
+    queue = current_app.extensions['jobs']
+    level = optimize.requested_level() if download_name.endswith('.pdf') else 0
+    if level:
+        func, args = optimize.run_optimized, (func, level, OUTPUT) + args
+    try:
+        job_id = queue.submit(func, *args, download_name=download_name)
+    except QueueFull:
+        response = jsonify(error="Job queue is full, try again later")
+        response.status_code = 429
+        response.headers['Retry-After'] = '5'
+        abort(response)
+
+    return jsonify(
+        job_id=job_id,
+        status='queued',
+        status_url=url_for('jobs.job_status', job_id=job_id),
+        download_url=url_for('jobs.job_download', job_id=job_id),
+    ), 202
+
+
+def _get_job(job_id):
+    job = current_app.extensions['jobs'].get(job_id)
+    if job is None:
+        abort(404, description="Job not found")
+    return job
+
+
+# Job status
+@blueprint.route('/jobs/<job_id>')
+def job_status(job_id):
+    return jsonify(_get_job(job_id).to_dict())
+
+
+# Job result
+@blueprint.route('/jobs/<job_id>/download')
+def job_download(job_id):
+    job = _get_job(job_id)
+    status = job.status
+    if status == 'failed':
+        return jsonify(job.to_dict()), 500
+    if status != 'done':
+        return jsonify(job.to_dict()), 409
+    return send_file(job.output_path, as_attachment=True, download_name=job.download_name)
@@ -1,7 +1,17 @@
-from flask import Flask, render_template_string, request, send_file
+from flask import Flask, Response, render_template_string, request, send_file
+import itertools
 import os
-import PyPDF2
-import io
+import time
+import compressing
+import jobs
+import metadata
+import optimize
+import merging
+import pdf_tools
+import profiling
+import splitting
+import storage
+import uploads
 
 app = Flask(__name__)
 
@@ -10,6 +20,41 @@ UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Background processing for ?async=1 requests
+jobs.init_app(app)
+
+# Uploads streamed to memory or disk as they arrive, checked to be PDFs
+uploads.init_app(app)
+
+# Uploads and results stored by content hash
+storage.init_app(app)
+
+# Optional rewrite of PDF outputs (object streams, compressed streams,
+# unreferenced objects dropped); ?optimize=<level> overrides the default
+optimize.init_app(app)
+
+# Stage timings in a Server-Timing header, Prometheus metrics on /metrics and
+# (with PROFILE_REQUESTS set) cProfile output for requests sent with ?profile=1
+profiling.init_app(app)
+
+# Worker processes and pages per shard for parallel text extraction
+# (None means one worker per CPU and an automatic shard size)
+app.config['TEXT_WORKERS'] = None
+app.config['TEXT_SHARD_SIZE'] = None
+
+# Worker processes writing the outputs of a multi-range split of a large
+# file, from a pool shared by all splits (None: one per CPU)
+app.config['SPLIT_WORKERS'] = None
+
+# Worker processes parsing merge inputs ahead of the writer, from a pool
+# shared by all merges; smaller merges than merging.MIN_PARALLEL_BYTES are
+# parsed in the request's process (None: one per CPU)
+app.config['MERGE_WORKERS'] = None
+
+# Worker processes re-encoding images for /compress (None: one per CPU),
+# shared by every request; small files are encoded in the request itself
+app.config['COMPRESS_WORKERS'] = None
+
 # CSS styles embedded in the script
 STYLE = '''
     * {
@@ -101,10 +146,12 @@ HOME_PAGE = '''
         </header>
         <div class="options">
             <a href="/splitter" class="btn">PDF Splitter</a>
+            <a href="/split_many" class="btn">PDF Multi Splitter</a>
             <a href="/merger" class="btn">PDF Merger</a>
             <a href="/rotate" class="btn">PDF Rotate</a>
             <a href="/extract_text" class="btn">Extract Text from PDF</a>
             <a href="/remove_page" class="btn">Remove Page from PDF</a>
+            <a href="/compress" class="btn">Compress PDF</a>
         </div>
     </body>
     </html>
@@ -137,6 +184,33 @@ SPLITTER_PAGE = '''
     </html>
 '''
 
+SPLIT_MANY_PAGE = '''
+    <html>
+    <head>
+        <title>PDF Multi Splitter</title>
+        <style>{{ style }}</style>
+    </head>
+    <body>
+        <header>
+            <h1>PDF Multi Splitter</h1>
+            <p>Split one PDF into many documents, downloaded as a ZIP file:</p>
+        </header>
+        <form action="/split_many" method="POST" enctype="multipart/form-data">
+            <label for="pdf_file">Upload PDF</label>
+            <input type="file" name="pdf_file" required>
+
+            <label for="ranges">Page Ranges (e.g. 1-3, 4-10, 11)</label>
+            <input type="text" name="ranges">
+
+            <label for="every">Or Split Every N Pages</label>
+            <input type="number" name="every" min="1">
+
+            <button type="submit" class="btn">Split PDF</button>
+        </form>
+    </body>
+    </html>
+'''
+
 MERGER_PAGE = '''
     <html>
     <head>
@@ -197,6 +271,15 @@ EXTRACT_TEXT_PAGE = '''
             <label for="pdf_file">Upload PDF</label>
             <input type="file" name="pdf_file" required>
 
+            <label for="stream">Output</label>
+            <select name="stream">
+                <option value="">Web page</option>
+                <option value="text">Plain text, streamed page by page</option>
+                <option value="ndjson">NDJSON, one line per page</option>
+            </select>
+
+            <label><input type="checkbox" name="parallel" value="1"> Use all CPU cores</label>
+
             <button type="submit" class="btn">Extract Text</button>
         </form>
     </body>
@@ -221,12 +304,47 @@ REMOVE_PAGE_PAGE = '''
             <label for="page_number">Page Number to Remove</label>
             <input type="number" name="page_number" required>
 
+            <label><input type="checkbox" name="incremental" value="1"> Fast (append an update; the removed page's data stays in the file and can be recovered)</label>
+
             <button type="submit" class="btn">Remove Page</button>
         </form>
     </body>
     </html>
 '''
 
+COMPRESS_PAGE = '''
+    <html>
+    <head>
+        <title>Compress PDF</title>
+        <style>{{ style }}</style>
+    </head>
+    <body>
+        <header>
+            <h1>Compress PDF</h1>
+            <p>Downsample and re-encode the images in a PDF:</p>
+        </header>
+        <form action="/compress" method="POST" enctype="multipart/form-data">
+            <label for="pdf_file">Upload PDF</label>
+            <input type="file" name="pdf_file" required>
+
+            <label for="dpi">Image Resolution (DPI)</label>
+            <input type="number" name="dpi" min="36" max="600" value="150">
+
+            <label for="mode">Image Encoding</label>
+            <select name="mode">
+                <option value="jpeg">JPEG (photos and color scans)</option>
+                <option value="bilevel">Black and white (text scans)</option>
+            </select>
+
+            <label for="quality">JPEG Quality (1-95)</label>
+            <input type="number" name="quality" min="1" max="95" value="75">
+
+            <button type="submit" class="btn">Compress PDF</button>
+        </form>
+    </body>
+    </html>
+'''
+
 # Home route
 @app.route('/')
 def home():
@@ -241,46 +359,99 @@ def splitter():
         end_page = int(request.form['end_page'])
 
         # Save uploaded PDF file
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-        file.save(pdf_path)
+        digest, pdf_source = storage.save_upload(file)
+        with profiling.stage('count'):
+            num_pages = metadata.page_count(pdf_source)
+        if not 1 <= start_page <= end_page <= num_pages:
+            return f"Pages must be in order and between 1 and {num_pages}", 400
+
+        # Split the PDF, reading only the objects the requested pages use
+        if jobs.wants_job():
+            return jobs.submit(splitting.split_range, pdf_source, start_page, end_page, jobs.OUTPUT,
+                               download_name='split_output.pdf')
+
+        stats = {}
+        output = storage.cached_result(
+            'split', [digest], {'start_page': start_page, 'end_page': end_page}, '.pdf',
+            lambda output: stats.update(splitting.split_range(pdf_source, start_page, end_page, output)),
+            buffered=storage.in_memory(pdf_source))
+
+        response = send_file(output, as_attachment=True, download_name='split_output.pdf')
+        if stats:
+            response.headers['X-Objects-Read'] = str(stats['objects_read'])
+            response.headers['X-Objects-In-File'] = str(stats['objects_in_file'])
+        return response
 
-        # Split the PDF
-        with open(pdf_path, 'rb') as pdf_file:
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            pdf_writer = PyPDF2.PdfWriter()
+    return render_template_string(SPLITTER_PAGE, style=STYLE)
 
-            for page_num in range(start_page - 1, end_page):
-                pdf_writer.add_page(pdf_reader.pages[page_num])
+# Split one PDF into many
+@app.route('/split_many', methods=['GET', 'POST'])
+def split_many():
+    if request.method == 'POST':
+        file = request.files['pdf_file']
+        every = int(request.form.get('every') or 0)
+        try:
+            ranges = None if every else splitting.parse_ranges(request.form.get('ranges', ''))
+        except ValueError as e:
+            return str(e), 400
+
+        # Save uploaded PDF file
+        digest, pdf_source = storage.save_upload(file)
+        with profiling.stage('count'):
+            num_pages = metadata.page_count(pdf_source)
+        if ranges and max(end for _, end in ranges) > num_pages:
+            return f"Page ranges must end at or before page {num_pages}", 400
 
-            output_path = os.path.join(app.config['UPLOAD_FOLDER'], 'split_output.pdf')
-            with open(output_path, 'wb') as output_file:
-                pdf_writer.write(output_file)
+        # Write every range into one ZIP
+        workers = app.config['SPLIT_WORKERS']
+        if jobs.wants_job():
+            return jobs.submit(splitting.split_to_zip, pdf_source, ranges, every, jobs.OUTPUT, workers,
+                               download_name='split_outputs.zip')
 
-        return send_file(output_path, as_attachment=True)
+        chunks = splitting.iter_split_zip(pdf_source, ranges, every, workers)
+        try:
+            first = next(chunks)
+        except (IndexError, ValueError) as e:
+            return str(e), 400
 
-    return render_template_string(SPLITTER_PAGE, style=STYLE)
+        return Response(itertools.chain([first], chunks), mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename=split_outputs.zip'})
+
+    return render_template_string(SPLIT_MANY_PAGE, style=STYLE)
 
 # PDF Merger
 @app.route('/merger', methods=['GET', 'POST'])
 def merger():
     if request.method == 'POST':
         files = request.files.getlist('pdf_files')
-        pdf_writer = PyPDF2.PdfWriter()
-
-        for file in files:
-            pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-            file.save(pdf_path)
-
-            with open(pdf_path, 'rb') as pdf_file:
-                pdf_reader = PyPDF2.PdfReader(pdf_file)
-                for page in pdf_reader.pages:
-                    pdf_writer.add_page(page)
-
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], 'merged_output.pdf')
-        with open(output_path, 'wb') as output_file:
-            pdf_writer.write(output_file)
-
-        return send_file(output_path, as_attachment=True)
+        started = time.perf_counter()
+        digests, pdf_sources = storage.save_uploads(files)
+        save_seconds = time.perf_counter() - started
+
+        workers = app.config['MERGE_WORKERS'] or os.cpu_count() or 1
+        if jobs.wants_job():
+            return jobs.submit(merging.merge_pdfs, pdf_sources, jobs.OUTPUT, workers,
+                               download_name='merged_output.pdf')
+
+        # Inputs are parsed (in worker processes when MERGE_WORKERS is set)
+        # and written in order by one writer, and fonts, images and other
+        # objects shared by the inputs are written once
+        stats = {}
+        output = storage.cached_result(
+            'merge', digests, {}, '.pdf',
+            lambda output: stats.update(merging.merge_pdfs(pdf_sources, output, workers)),
+            buffered=storage.in_memory(*pdf_sources))
+
+        if stats:
+            profiling.add_timings(stats['timings'])
+            profiling.count('pages', stats['pages'])
+        response = send_file(output, as_attachment=True, download_name='merged_output.pdf')
+        timings = {'save': save_seconds, **stats.get('timings', {})}
+        response.headers['X-Stage-Timings'] = ", ".join(f"{stage}={seconds:.3f}" for stage, seconds in timings.items())
+        if stats:
+            response.headers['X-Duplicate-Objects'] = str(stats['duplicates'])
+            response.headers['X-Bytes-Saved'] = str(stats['bytes_saved'])
+        return response
 
     return render_template_string(MERGER_PAGE, style=STYLE)
 
@@ -291,34 +462,19 @@ def rotate():
         file = request.files['pdf_file']
         degree = int(request.form['degree'])
 
-        # Normalize degree to be between 0 and 360
-        degree = degree % 360
-
         # Save uploaded PDF file
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-        file.save(pdf_path)
+        digest, pdf_source = storage.save_upload(file)
 
         # Rotate the PDF
-        with open(pdf_path, 'rb') as pdf_file:
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            pdf_writer = PyPDF2.PdfWriter()
-
-            for page in pdf_reader.pages:
-                # Get current rotation
-                current_rotation = page.get('/Rotate', 0)
-                
-                # Calculate new rotation
-                new_rotation = (current_rotation + degree) % 360
-                
-                # Create a new page object
-                page.rotate(new_rotation)
-                pdf_writer.add_page(page)
-
-            output_path = os.path.join(app.config['UPLOAD_FOLDER'], 'rotated_output.pdf')
-            with open(output_path, 'wb') as output_file:
-                pdf_writer.write(output_file)
-
-        return send_file(output_path, as_attachment=True)
+        if jobs.wants_job():
+            return jobs.submit(pdf_tools.rotate_pdf, pdf_source, degree, jobs.OUTPUT, download_name='rotated_output.pdf')
+
+        output = storage.cached_result(
+            'rotate', [digest], {'degree': degree % 360}, '.pdf',
+            lambda output: pdf_tools.rotate_pdf(pdf_source, degree, output),
+            buffered=storage.in_memory(pdf_source))
+
+        return send_file(output, as_attachment=True, download_name='rotated_output.pdf')
 
     return render_template_string(ROTATE_PAGE, style=STYLE)
 
@@ -329,15 +485,25 @@ def extract_text():
         file = request.files['pdf_file']
 
         # Save uploaded PDF file
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-        file.save(pdf_path)
+        digest, pdf_source = storage.save_upload(file)
+
+        # Extract text from the PDF, sharded over worker processes when asked to
+        workers = app.config['TEXT_WORKERS'] if request.values.get('parallel') else 1
+        shard_size = app.config['TEXT_SHARD_SIZE']
 
-        # Extract text from the PDF
-        with open(pdf_path, 'rb') as pdf_file:
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text()
+        stream = request.values.get('stream')
+        if stream in ('text', 'ndjson'):
+            mimetype = 'application/x-ndjson' if stream == 'ndjson' else 'text/plain'
+            return Response(pdf_tools.stream_text(pdf_source, stream, workers, shard_size), mimetype=mimetype)
+
+        if jobs.wants_job():
+            return jobs.submit(pdf_tools.extract_text_to_file, pdf_source, jobs.OUTPUT, workers, shard_size,
+                               download_name='extracted_text.txt')
+
+        text = storage.read_text(storage.cached_result(
+            'extract_text', [digest], {}, '.txt',
+            lambda output: pdf_tools.extract_text_to_file(pdf_source, output, workers, shard_size),
+            buffered=storage.in_memory(pdf_source)))
 
         return f"<pre>{text}</pre>"
 
@@ -349,27 +515,67 @@ def remove_page():
     if request.method == 'POST':
         file = request.files['pdf_file']
         page_number = int(request.form['page_number'])
+        # Incremental removal keeps the page's data in the file, so it is opt-in
+        compact = not request.form.get('incremental')
 
         # Save uploaded PDF file
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-        file.save(pdf_path)
+        digest, pdf_source = storage.save_upload(file)
+        with profiling.stage('count'):
+            num_pages = metadata.page_count(pdf_source)
+        if not 1 <= page_number <= num_pages:
+            return f"Page number must be between 1 and {num_pages}", 400
 
         # Remove the specified page
-        with open(pdf_path, 'rb') as pdf_file:
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            pdf_writer = PyPDF2.PdfWriter()
+        if jobs.wants_job():
+            return jobs.submit(pdf_tools.remove_page, pdf_source, page_number, jobs.OUTPUT, compact,
+                               download_name='removed_page_output.pdf')
 
-            for i, page in enumerate(pdf_reader.pages):
-                if i != page_number - 1:
-                    pdf_writer.add_page(page)
+        output = storage.cached_result(
+            'remove_page', [digest], {'page_number': page_number, 'compact': compact}, '.pdf',
+            lambda output: pdf_tools.remove_page(pdf_source, page_number, output, compact),
+            buffered=storage.in_memory(pdf_source))
 
-            output_path = os.path.join(app.config['UPLOAD_FOLDER'], 'removed_page_output.pdf')
-            with open(output_path, 'wb') as output_file:
-                pdf_writer.write(output_file)
-
-        return send_file(output_path, as_attachment=True)
+        return send_file(output, as_attachment=True, download_name='removed_page_output.pdf')
 
     return render_template_string(REMOVE_PAGE_PAGE, style=STYLE)
 
+# Compress the images in a PDF
+@app.route('/compress', methods=['GET', 'POST'])
+def compress():
+    if request.method == 'POST':
+        if not compressing.available():
+            return "Image compression needs Pillow installed on the server", 503
+        file = request.files['pdf_file']
+        dpi = request.form.get('dpi', 150, type=int)
+        mode = request.form.get('mode', 'jpeg')
+        quality = request.form.get('quality', 75, type=int)
+        if mode not in compressing.MODES or not 36 <= dpi <= 600 or not 1 <= quality <= 95:
+            return "Resolution must be 36-600 DPI, quality 1-95 and the encoding jpeg or bilevel", 400
+
+        # Save uploaded PDF file
+        digest, pdf_source = storage.save_upload(file)
+
+        # Images of large files are encoded in worker processes (see
+        # compressing.MIN_PARALLEL_BYTES)
+        workers = app.config['COMPRESS_WORKERS']
+        if jobs.wants_job():
+            return jobs.submit(compressing.compress_pdf, pdf_source, jobs.OUTPUT, dpi, mode, quality, workers,
+                               download_name='compressed_output.pdf')
+
+        stats = {}
+        output = storage.cached_result(
+            'compress', [digest], {'dpi': dpi, 'mode': mode, 'quality': quality}, '.pdf',
+            lambda output: stats.update(compressing.compress_pdf(pdf_source, output, dpi, mode, quality, workers)),
+            buffered=storage.in_memory(pdf_source))
+
+        response = send_file(output, as_attachment=True, download_name='compressed_output.pdf')
+        if stats:
+            response.headers['X-Images-Recompressed'] = str(stats['recompressed'])
+            response.headers['X-Duplicate-Images'] = str(stats['duplicates'])
+            response.headers['X-Bytes-Saved'] = str(stats['bytes_saved'])
+        return response
+
+    return render_template_string(COMPRESS_PAGE, style=STYLE)
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,301 @@
+import hashlib
+import io
+import os
+import time
+from collections import deque
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+
+import pools
+from pdf_tools import open_output, open_source
+from pdf_writing import ObjectCopier, Output, serialize, write_xref_table
+
+HEADER = b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n"
+
+# Inputs adding up to fewer bytes than this are parsed in the calling process
+# even when workers are configured; handing them to a pool costs more than
+# parsing them
+MIN_PARALLEL_BYTES = 4 * 1024 * 1024
+
+# Object numbers of the catalog and page tree root in every merged file
+CATALOG_ID = 1
+PAGES_ID = 2
+
+# Local number standing for the output's page tree root in a prepared input
+LOCAL_PAGES_ID = 0
+
+
+# One input's pages copied out of its reader and numbered locally: objects in
+# the order they are written (children before parents, except across
+# reference cycles), each with its content digest and serialized size, and
+# the local numbers of its pages. Plain PDF objects only, so it can be built
+# in a worker process and sent back to the writer.
+class PreparedInput:
+    def __init__(self):
+        self.objects = []
+        self.page_ids = []
+        self.next_id = LOCAL_PAGES_ID + 1
+        self.seconds = 0.0
+
+    def reserve(self):
+        idnum = self.next_id
+        self.next_id += 1
+        return idnum
+
+
+# Copies the objects reachable from one reader's pages into a PreparedInput.
+# Every object except the pages, and anything that depends on a page or on a
+# reference cycle, gets a digest of its content in which references are
+# replaced by the digests of what they point at, so identical objects from
+# different inputs get identical digests whatever their object numbers.
+class _InputCopier(ObjectCopier):
+    def __init__(self, prepared):
+        self.prepared = prepared
+        self.ids = {}
+        self.pending = {}
+        self.digests = {}
+
+    def copy_ref(self, ref):
+        key = (ref.idnum, ref.generation)
+        if key in self.ids:
+            return self.ids[key]
+        if key in self.pending:
+            # A reference cycle: the object is already being copied, so it
+            # gets its number now and is never deduplicated
+            if self.pending[key] is None:
+                self.pending[key] = self.prepared.reserve()
+            return self.pending[key]
+
+        self.pending[key] = None
+        copy = self.copy_object(ref.get_object())
+        idnum = self.pending.pop(key)
+
+        digest = None
+        if idnum is None:
+            idnum = self.prepared.reserve()
+            digest = self.digest(copy)
+            if digest is not None:
+                self.digests[idnum] = digest
+        self.ids[key] = idnum
+        self.prepared.objects.append((idnum, copy, digest, len(serialize(copy))))
+        return idnum
+
+    def _canonical(self, value, parts):
+        if isinstance(value, IndirectObject):
+            digest = self.digests.get(value.idnum)
+            if digest is None:
+                return False
+            parts.append(b"R" + digest)
+        elif isinstance(value, DictionaryObject):
+            parts.append(b"<<")
+            for key, item in value.items():
+                parts.append(serialize(NameObject(key)))
+                if not self._canonical(item, parts):
+                    return False
+            parts.append(b">>")
+            if isinstance(value, StreamObject):
+                parts.append(b"stream" + hashlib.sha256(value._data).digest())
+        elif isinstance(value, ArrayObject):
+            parts.append(b"[")
+            for item in value:
+                if not self._canonical(item, parts):
+                    return False
+            parts.append(b"]")
+        else:
+            parts.append(b" " + serialize(value))
+        return True
+
+    def digest(self, copy):
+        parts = []
+        if not self._canonical(copy, parts):
+            return None
+        return hashlib.sha256(b"".join(parts)).digest()
+
+    # Copy every page of the reader, with inherited attributes made explicit
+    def copy_pages(self, reader):
+        pages = list(reader.pages)
+
+        # Number the pages up front so annotations and links that point at
+        # other pages of the same input are rewritten to the copies
+        for page in pages:
+            page_id = self.prepared.reserve()
+            if page.indirect_reference is not None:
+                ref = page.indirect_reference
+                self.ids[(ref.idnum, ref.generation)] = page_id
+            self.prepared.page_ids.append(page_id)
+
+        for page, page_id in zip(pages, self.prepared.page_ids):
+            copy = DictionaryObject()
+            for key, value in page.items():
+                if key != '/Parent':
+                    copy[NameObject(key)] = self.copy_value(value)
+            copy[NameObject('/Parent')] = IndirectObject(LOCAL_PAGES_ID, 0, None)
+            self.prepared.objects.append((page_id, copy, None, 0))
+
+
+# Parse and validate one input and copy its pages out of the reader, which
+# is closed before returning; runs in the merge's worker processes
+def prepare(pdf_source):
+    started = time.perf_counter()
+    prepared = PreparedInput()
+    with open_source(pdf_source) as pdf_file:
+        reader = PdfReader(pdf_file)
+        if reader.is_encrypted:
+            reader.decrypt('')
+        _InputCopier(prepared).copy_pages(reader)
+    prepared.seconds = time.perf_counter() - started
+    return prepared
+
+
+# Writes prepared inputs into one output, renumbering their objects. Objects
+# whose digest has already been written, such as fonts, logos, ICC profiles
+# and form XObjects shared by several inputs, are emitted once and later
+# copies point at the first.
+#
+# Objects are written to output_file as soon as they are added and only their
+# offsets are kept, so once an input has been added it can be dropped and
+# peak memory is bounded by the inputs in flight, not the total.
+class DedupMerger:
+    def __init__(self, output_file):
+        self.out = Output(output_file)
+        self.entries = {}
+        self.next_id = PAGES_ID + 1
+        self.page_ids = []
+        self.by_hash = {}
+        self.stats = {'inputs': 0, 'pages': 0, 'objects': 0, 'duplicates': 0, 'bytes_saved': 0}
+
+    def _reserve(self):
+        idnum = self.next_id
+        self.next_id += 1
+        return idnum
+
+    def _emit(self, idnum, data):
+        if not self.out.position:
+            self.out.write(HEADER)
+        self.entries[idnum] = self.out.write_object(idnum, data)
+        self.stats['objects'] += 1
+
+    # Output number for a local one, allocated on first sight (pages and
+    # objects in reference cycles are referenced before they are written)
+    def _output_id(self, ids, local_id):
+        if local_id not in ids:
+            ids[local_id] = self._reserve()
+        return ids[local_id]
+
+    def _renumber(self, value, ids):
+        if isinstance(value, IndirectObject):
+            return IndirectObject(self._output_id(ids, value.idnum), 0, None)
+        if isinstance(value, DictionaryObject):
+            for key, item in value.items():
+                value[key] = self._renumber(item, ids)
+        elif isinstance(value, ArrayObject):
+            for index, item in enumerate(value):
+                value[index] = self._renumber(item, ids)
+        return value
+
+    def add(self, prepared):
+        ids = {LOCAL_PAGES_ID: PAGES_ID}
+        for local_id, obj, digest, size in prepared.objects:
+            if digest is not None and digest in self.by_hash:
+                ids[local_id] = self.by_hash[digest]
+                self.stats['duplicates'] += 1
+                self.stats['bytes_saved'] += size
+                continue
+
+            idnum = self._output_id(ids, local_id)
+            if digest is not None:
+                self.by_hash[digest] = idnum
+            self._emit(idnum, serialize(self._renumber(obj, ids)))
+
+        self.page_ids.extend(ids[page_id] for page_id in prepared.page_ids)
+        self.stats['inputs'] += 1
+        self.stats['pages'] += len(prepared.page_ids)
+
+    # Write the catalog and page tree, which are only complete once every
+    # input has been added, then the xref table and the trailer
+    def finish(self):
+        catalog = DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): IndirectObject(PAGES_ID, 0, None),
+        })
+        pages = DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject(IndirectObject(idnum, 0, None) for idnum in self.page_ids),
+            NameObject('/Count'): NumberObject(len(self.page_ids)),
+        })
+        self._emit(CATALOG_ID, serialize(catalog))
+        self._emit(PAGES_ID, serialize(pages))
+
+        trailer = DictionaryObject({NameObject('/Root'): IndirectObject(CATALOG_ID, 0, None)})
+        write_xref_table(self.out, self.entries, self.next_id, trailer)
+
+
+def _source_size(pdf_source):
+    if isinstance(pdf_source, io.BytesIO):
+        return pdf_source.getbuffer().nbytes
+    return os.path.getsize(pdf_source)
+
+
+# True when inputs are worth parsing in worker processes
+def _parallel(pdf_sources, workers):
+    return workers > 1 and len(pdf_sources) > 1 and \
+        sum(_source_size(pdf_source) for pdf_source in pdf_sources) >= MIN_PARALLEL_BYTES
+
+
+# Prepared inputs in order. With several workers, inputs are parsed in the
+# shared pool while the writer consumes earlier ones; at most two per worker
+# are in flight, so parsing can't run arbitrarily far ahead of writing.
+def _prepare_all(pdf_sources, workers):
+    if workers <= 1:
+        for pdf_source in pdf_sources:
+            yield prepare(pdf_source)
+        return
+
+    executor = pools.executor(workers)
+    in_flight = deque()
+    try:
+        for pdf_source in pdf_sources:
+            in_flight.append(executor.submit(prepare, pdf_source))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+# Merge every page of every input, in order, emitting objects shared between
+# inputs once; workers > 1 parses inputs in that many processes when they
+# are large enough (see MIN_PARALLEL_BYTES). Returns the merge statistics,
+# including bytes_saved and the seconds spent parsing (summed over workers),
+# waiting for parsed inputs and writing.
+def merge_pdfs(pdf_sources, output, workers=1):
+    timings = {'parse': 0.0, 'wait': 0.0, 'write': 0.0}
+    if not _parallel(pdf_sources, workers):
+        workers = 1
+    with open_output(output) as output_file:
+        merger = DedupMerger(output_file)
+        inputs = _prepare_all(pdf_sources, workers)
+        while True:
+            started = time.perf_counter()
+            prepared = next(inputs, None)
+            timings['wait'] += time.perf_counter() - started
+            if prepared is None:
+                break
+
+            timings['parse'] += prepared.seconds
+            started = time.perf_counter()
+            merger.add(prepared)
+            timings['write'] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        merger.finish()
+        timings['write'] += time.perf_counter() - started
+
+    # Serial parsing happens inside next(), so it is not also waiting time
+    if workers <= 1:
+        timings['wait'] = 0.0
+    merger.stats['timings'] = timings
+    return merger.stats
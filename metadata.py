@@ -0,0 +1,131 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+from flask import current_app
+from PyPDF2 import PdfReader
+
+from pdf_tools import open_source
+
+# Bump when the tables change; an index of another version is rebuilt
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    digest TEXT PRIMARY KEY,
+    pages INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    digest TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    x0 REAL, y0 REAL, x1 REAL, y1 REAL,
+    rotate INTEGER NOT NULL,
+    PRIMARY KEY (digest, page)
+);
+"""
+
+
+def _resolve(value):
+    return value.get_object() if hasattr(value, 'get_object') else value
+
+
+# Facts about a document gathered in one parse: page count and each page's
+# media box and rotation
+def describe(pdf_source):
+    with open_source(pdf_source) as pdf_file:
+        reader = PdfReader(pdf_file)
+        pages = []
+        for page in reader.pages:
+            box = page.mediabox
+            pages.append({
+                'mediabox': [float(box.left), float(box.bottom), float(box.right), float(box.top)],
+                'rotate': int(_resolve(page.get('/Rotate', 0))) % 360,
+            })
+    return {'pages': len(pages), 'page_info': pages}
+
+
+# Page count from the page tree root's /Count, which only needs the xref
+# table and the catalog rather than every page
+def page_count(pdf_source):
+    with open_source(pdf_source) as pdf_file:
+        reader = PdfReader(pdf_file)
+        return int(reader.trailer['/Root']['/Pages'].get('/Count', 0))
+
+
+# SQLite index of describe() results keyed by the content hash of the file
+class MetadataIndex:
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self._connect()
+        try:
+            if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                db.executescript("DROP TABLE IF EXISTS documents; DROP TABLE IF EXISTS pages;")
+            db.executescript(SCHEMA)
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, digest):
+        db = self._connect()
+        try:
+            row = db.execute("SELECT pages FROM documents WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                return None
+            rows = db.execute("SELECT x0, y0, x1, y1, rotate FROM pages WHERE digest = ? ORDER BY page",
+                              (digest,)).fetchall()
+        finally:
+            db.close()
+
+        return {
+            'pages': row[0],
+            'page_info': [{'mediabox': list(r[:4]), 'rotate': r[4]} for r in rows],
+        }
+
+    def put(self, digest, info):
+        db = self._connect()
+        try:
+            with db:
+                db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                           (digest, info['pages'], time.time()))
+                db.execute("DELETE FROM pages WHERE digest = ?", (digest,))
+                db.executemany(
+                    "INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(digest, number, *page['mediabox'], page['rotate'])
+                     for number, page in enumerate(info['page_info'], 1)])
+        finally:
+            db.close()
+
+    # Indexed facts for a document, describing (and storing) it on first sight
+    def ensure(self, digest, pdf_source):
+        info = self.get(digest)
+        if info is None:
+            info = describe(pdf_source)
+            self.put(digest, info)
+        return info
+
+
+# Attach a metadata index to an app, next to its uploads
+def init_app(app):
+    app.config.setdefault('METADATA_DB', os.path.join(app.config['UPLOAD_FOLDER'], 'metadata.sqlite3'))
+    app.extensions['metadata'] = MetadataIndex(app.config['METADATA_DB'])
+
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as pdf_file:
+        for chunk in iter(lambda: pdf_file.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# Indexed facts for a file on disk, looked up by its content hash
+def index_file(path):
+    return current_app.extensions['metadata'].ensure(file_digest(path), path)
@@ -0,0 +1,227 @@
+import io
+import threading
+from collections import OrderedDict
+
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+
+import profiling
+from pdf_tools import open_output, open_source
+
+# Horizontal offset of the stamp for each position, on a letter-sized page;
+# other page widths scale it proportionally
+POSITIONS = {
+    'left': 10,
+    'middle': 270,
+    'right': 500,
+}
+
+# Distance of the stamp's baseline from the bottom edge of the page as shown
+BOTTOM_MARGIN = 10
+
+# Resource name used for the stamp font on every page
+FONT_NAME = '/FPgNum'
+
+
+# Build the text of every stamp from a format such as "Page {page} of {total}"
+def page_labels(label_format, total_pages):
+    return [label_format.format(page=i + 1, total=total_pages) for i in range(total_pages)]
+
+
+# Geometry of a page: its media box and its /Rotate, normalised to one of
+# 0, 90, 180 or 270
+def page_geometry(page):
+    box = page.mediabox
+    x0, x1 = sorted((float(box.left), float(box.right)))
+    y0, y1 = sorted((float(box.bottom), float(box.top)))
+    rotation = page.get('/Rotate', 0)
+    rotation = int(getattr(rotation, 'get_object', lambda: rotation)()) % 360
+    return (x0, y0, x1, y1), rotation - rotation % 90
+
+
+# Text matrix placing a stamp at position along the bottom of the page as it
+# is displayed, reading upright whatever the page's rotation
+def placement(position, page_box, rotation):
+    x0, y0, x1, y1 = page_box
+    width = y1 - y0 if rotation % 180 else x1 - x0
+    u = POSITIONS.get(position, 0) * width / letter[0]
+    v = BOTTOM_MARGIN
+    if rotation == 90:
+        return (0, 1, -1, 0, x1 - v, y0 + u)
+    if rotation == 180:
+        return (-1, 0, 0, -1, x1 - u, y1 - v)
+    if rotation == 270:
+        return (0, -1, 1, 0, x0 + v, y1 - u)
+    return (1, 0, 0, 1, x0 + u, y0 + v)
+
+
+# Draw all stamps in a single reportlab pass: one overlay page per label,
+# sized and oriented for the page it will be merged onto (geometries as
+# returned by page_geometry; letter pages when not given)
+def render_overlay(labels, position, font_size=10, geometries=None):
+    packet = io.BytesIO()
+    c = canvas.Canvas(packet, pagesize=letter)
+    if geometries is None:
+        geometries = [((0, 0) + letter, 0)] * len(labels)
+
+    for label, (page_box, rotation) in zip(labels, geometries):
+        c.setPageSize((page_box[2], page_box[3]))
+        c.setFont("Helvetica", font_size)
+        if position in POSITIONS:
+            c.transform(*placement(position, page_box, rotation))
+            c.drawString(0, 0, label)
+        c.showPage()
+
+    c.save()
+    packet.seek(0)
+    return PdfReader(packet)
+
+
+# Everything a stamp needs except its text: the font resource and the
+# positioned text operators around the label
+class StampTemplate:
+    def __init__(self, label_format, position, font_size, page_box, rotation=0):
+        self.font = DictionaryObject({
+            NameObject('/Type'): NameObject('/Font'),
+            NameObject('/Subtype'): NameObject('/Type1'),
+            NameObject('/BaseFont'): NameObject('/Helvetica'),
+            NameObject('/Encoding'): NameObject('/WinAnsiEncoding'),
+        })
+        self.visible = position in POSITIONS
+        matrix = " ".join(f"{value:g}" for value in placement(position, page_box, rotation))
+        self.head = f"Q\nq BT {FONT_NAME} {font_size} Tf {matrix} Tm (".encode()
+        self.tail = b") Tj ET Q\n"
+
+    def content(self, label):
+        if not self.visible:
+            return b"Q\n"
+        text = label.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        return self.head + text.encode('cp1252', 'replace') + self.tail
+
+
+# Bounded LRU of stamp templates, shared by every request in the process
+class StampTemplateCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, label_format, position, font_size, page_box, rotation=0):
+        key = (label_format, position, font_size, page_box, rotation)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return template
+            self.misses += 1
+
+        template = StampTemplate(label_format, position, font_size, page_box, rotation)
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._templates),
+                'maxsize': self.maxsize,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+STAMP_CACHE = StampTemplateCache()
+
+
+def _stream(writer, data):
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    return writer._add_object(stream)
+
+
+# Append a stamp content stream to a page that already belongs to the writer
+def _append_stamp(writer, page, template, label, font_ref, save_state):
+    resources = page.get('/Resources')
+    if resources is None:
+        resources = DictionaryObject()
+        page[NameObject('/Resources')] = resources
+    resources = resources.get_object()
+    fonts = resources.get('/Font')
+    if fonts is None:
+        fonts = DictionaryObject()
+        resources[NameObject('/Font')] = fonts
+    fonts = fonts.get_object()
+
+    fonts[NameObject(FONT_NAME)] = font_ref
+
+    contents = page.get('/Contents')
+    if contents is None:
+        contents = ArrayObject()
+    elif isinstance(contents.get_object(), ArrayObject):
+        contents = ArrayObject(contents.get_object())
+    else:
+        contents = ArrayObject([contents])
+    page[NameObject('/Contents')] = ArrayObject(
+        [save_state] + contents + [_stream(writer, template.content(label))]
+    )
+
+
+# Stamp by rendering one overlay document and merging its pages
+def stamp_with_overlay(reader, writer, labels, position, font_size):
+    pages = list(reader.pages)
+    overlay = render_overlay(labels, position, font_size, [page_geometry(page) for page in pages])
+    for page, stamp in zip(pages, overlay.pages):
+        page.merge_page(stamp)
+        writer.add_page(page)
+
+
+# Stamp by appending a content stream built from a cached template. Pages are
+# grouped by geometry, so a document needs one template per distinct page
+# size and rotation rather than one per page.
+def stamp_with_templates(reader, writer, labels, position, font_size, label_format, cache=STAMP_CACHE):
+    save_state = _stream(writer, b"q\n")
+    font_ref = None
+    templates = {}
+    for page, label in zip(reader.pages, labels):
+        geometry = page_geometry(page)
+        template = templates.get(geometry)
+        if template is None:
+            template = templates[geometry] = cache.get(label_format, position, font_size, *geometry)
+        page = writer.add_page(page)
+        if font_ref is None:
+            font_ref = writer._add_object(template.font.clone(writer))
+        _append_stamp(writer, page, template, label, font_ref, save_state)
+
+
+# Stamp page numbers onto every page of a PDF
+def add_page_numbers(input_pdf, output_pdf, label_format, position, font_size=10,
+                     engine='template'):
+    with open_source(input_pdf) as input_file:
+        with profiling.stage('parse'):
+            reader = PdfReader(input_file)
+            labels = page_labels(label_format, len(reader.pages))
+        writer = PdfWriter()
+        profiling.count('pages', len(labels))
+
+        with profiling.stage('add_page'):
+            if engine == 'overlay':
+                stamp_with_overlay(reader, writer, labels, position, font_size)
+            else:
+                stamp_with_templates(reader, writer, labels, position, font_size, label_format)
+
+        with profiling.stage('write'), open_output(output_pdf) as output_file:
+            writer.write(output_file)
+    return output_pdf
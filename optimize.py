@@ -0,0 +1,235 @@
+import io
+import os
+import re
+import time
+import uuid
+import zlib
+from collections import deque
+
+from flask import current_app, g, request
+from PyPDF2 import PdfReader
+from PyPDF2.filters import ASCII85Decode
+from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject, NullObject, NumberObject, StreamObject
+
+import profiling
+from pdf_tools import is_path, open_output, open_source
+from pdf_writing import ObjectCopier, Output, serialize, write_xref_stream, write_xref_table
+
+# Object and xref streams need PDF 1.5; newer inputs keep their version
+MIN_VERSION = (1, 5)
+
+# What each level does, trading CPU for bytes. Every level drops objects
+# that can't be reached from the trailer and Flate-compresses streams that
+# have no filter (see _compress_stream); level 2 also packs objects into object streams indexed by
+# a compressed xref stream, and level 3 recompresses Flate streams at the
+# highest zlib level when that makes them smaller.
+LEVELS = {
+    1: {'zlib': 1, 'object_streams': False, 'recompress': False},
+    2: {'zlib': 6, 'object_streams': True, 'recompress': False},
+    3: {'zlib': 9, 'object_streams': True, 'recompress': True},
+}
+
+# Objects packed into each object stream
+OBJECTS_PER_STREAM = 100
+
+
+# Header for the rewrite of a file: its own version, raised to MIN_VERSION
+def _header(pdf_file):
+    pdf_file.seek(0)
+    match = re.search(rb"%PDF-(\d+)\.(\d+)", pdf_file.read(1024))
+    version = max((int(match.group(1)), int(match.group(2))), MIN_VERSION) if match else MIN_VERSION
+    return b"%%PDF-%d.%d\n%%\xe2\xe3\xcf\xd3\n" % version
+
+
+# Bytes a /Filter /FlateDecode entry adds to a stream's dictionary
+FILTER_OVERHEAD = 22
+
+
+# Flate-compress a stream with no filter when that makes it smaller, drop an
+# ASCII85 layer over Flate data (a quarter of the stream's size), and at the
+# levels that ask for it recompress Flate data harder
+def _compress_stream(copy, settings):
+    filters = copy.get('/Filter')
+    if isinstance(filters, ArrayObject) and list(filters) == ['/ASCII85Decode', '/FlateDecode'] \
+            and '/DecodeParms' not in copy:
+        try:
+            copy._data = ASCII85Decode.decode(copy._data)
+        except ValueError:
+            return
+        filters = copy[NameObject('/Filter')] = NameObject('/FlateDecode')
+
+    if filters is None:
+        data = zlib.compress(copy._data, settings['zlib'])
+        if len(data) + FILTER_OVERHEAD < len(copy._data):
+            copy._data = data
+            copy[NameObject('/Filter')] = NameObject('/FlateDecode')
+    elif settings['recompress'] and filters == '/FlateDecode' and '/DecodeParms' not in copy:
+        try:
+            data = zlib.compress(zlib.decompress(copy._data), settings['zlib'])
+        except zlib.error:
+            return
+        if len(data) < len(copy._data):
+            copy._data = data
+
+
+# Copy of every object reachable from the trailer, renumbered from 1 in the
+# order they are found; objects nothing points at are left behind
+class _Collector(ObjectCopier):
+    def __init__(self, reader, settings):
+        self.settings = settings
+        self.ids = {}
+        self.objects = []
+        self.queue = deque()
+
+    def copy_ref(self, ref):
+        key = (ref.idnum, ref.generation)
+        if key not in self.ids:
+            self.ids[key] = len(self.ids) + 1
+            self.queue.append(ref)
+        return self.ids[key]
+
+    def collect(self):
+        while self.queue:
+            obj = self.queue.popleft().get_object()
+            copy = NullObject() if obj is None else self.copy_object(obj)
+            if isinstance(copy, StreamObject):
+                _compress_stream(copy, self.settings)
+            self.objects.append(copy)
+
+
+def _object_stream(entries, settings):
+    offsets = []
+    body = io.BytesIO()
+    for idnum, data in entries:
+        offsets.append(b"%d %d" % (idnum, body.tell()))
+        body.write(data + b"\n")
+    header = b" ".join(offsets) + b"\n"
+
+    stream = StreamObject()
+    stream._data = zlib.compress(header + body.getvalue(), settings['zlib'])
+    stream[NameObject('/Type')] = NameObject('/ObjStm')
+    stream[NameObject('/N')] = NumberObject(len(entries))
+    stream[NameObject('/First')] = NumberObject(len(header))
+    stream[NameObject('/Filter')] = NameObject('/FlateDecode')
+    return serialize(stream)
+
+
+# Rewrite a PDF at level (see LEVELS); returns the bytes in and out and the
+# seconds it took. Encrypted inputs are copied unchanged.
+def optimize_pdf(pdf_source, output, level=2):
+    started = time.perf_counter()
+    settings = LEVELS[level]
+    with open_source(pdf_source) as pdf_file:
+        pdf_file.seek(0, io.SEEK_END)
+        bytes_in = pdf_file.tell()
+        header = _header(pdf_file)
+        pdf_file.seek(0)
+        reader = PdfReader(pdf_file)
+
+        with open_output(output) as output_file:
+            out = Output(output_file)
+            if reader.is_encrypted:
+                pdf_file.seek(0)
+                out.write(pdf_file.read())
+                return {'level': level, 'bytes_in': bytes_in, 'bytes_out': out.position,
+                        'seconds': time.perf_counter() - started}
+
+            collector = _Collector(reader, settings)
+            trailer = DictionaryObject()
+            for key in ('/Root', '/Info', '/ID'):
+                if key in reader.trailer:
+                    trailer[NameObject(key)] = collector.copy_value(reader.trailer.raw_get(key))
+            collector.collect()
+
+            out.write(header)
+            entries = {}
+            packed = []
+            for idnum, obj in enumerate(collector.objects, 1):
+                if settings['object_streams'] and not isinstance(obj, StreamObject):
+                    packed.append((idnum, serialize(obj)))
+                else:
+                    entries[idnum] = out.write_object(idnum, serialize(obj))
+
+            size = len(collector.objects) + 1
+            for start in range(0, len(packed), OBJECTS_PER_STREAM):
+                chunk = packed[start:start + OBJECTS_PER_STREAM]
+                stream_id = size
+                size += 1
+                entries[stream_id] = out.write_object(stream_id, _object_stream(chunk, settings))
+                for index, (idnum, _) in enumerate(chunk):
+                    entries[idnum] = (2, stream_id, index)
+
+            if settings['object_streams']:
+                write_xref_stream(out, entries, size, trailer, zlib_level=settings['zlib'])
+            else:
+                write_xref_table(out, entries, size, trailer)
+
+        bytes_out = out.position
+    return {'level': level, 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+            'seconds': time.perf_counter() - started}
+
+
+# Optimize a finished output in place, given as a path or a buffer; the
+# output is left as it was when the rewrite isn't smaller (files that
+# already use object streams, at level 1)
+def optimize_output(output, level):
+    if is_path(output):
+        tmp_path = f"{output}.{uuid.uuid4().hex}.tmp"
+        try:
+            stats = optimize_pdf(output, tmp_path, level)
+            if stats['bytes_out'] < stats['bytes_in']:
+                os.replace(tmp_path, output)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    else:
+        optimized = io.BytesIO()
+        stats = optimize_pdf(io.BytesIO(output.getvalue()), optimized, level)
+        if stats['bytes_out'] < stats['bytes_in']:
+            output.seek(0)
+            output.truncate()
+            output.write(optimized.getvalue())
+
+    stats['bytes_out'] = min(stats['bytes_out'], stats['bytes_in'])
+    return stats
+
+
+# Run build(output), then optimize what it wrote, recording the stats on g
+# for the X-Optimize response header
+def optimized(build, level):
+    def build_optimized(output):
+        build(output)
+        with profiling.stage('optimize'):
+            g.optimize_stats = optimize_output(output, level)
+    return build_optimized
+
+
+# Job form of optimized(): func(*args) writes output, which is then optimized
+def run_optimized(func, level, output, *args):
+    result = func(*args)
+    optimize_output(output, level)
+    return result
+
+
+# Level asked for with ?optimize= (or an optimize form field), else the app's
+# OPTIMIZE_LEVEL; 0 means outputs are written as the tools produce them
+def requested_level():
+    level = request.values.get('optimize', type=int)
+    if level is None:
+        level = current_app.config.get('OPTIMIZE_LEVEL', 0)
+    return level if level in LEVELS else 0
+
+
+def _report(response):
+    stats = g.get('optimize_stats')
+    if stats:
+        response.headers['X-Optimize'] = ", ".join(f"{key}={value:.3f}" if isinstance(value, float)
+                                                   else f"{key}={value}" for key, value in stats.items())
+    return response
+
+
+# Default level for an app's tool outputs, and the X-Optimize header that
+# reports the size and time cost of optimizing a freshly built result
+def init_app(app):
+    app.config.setdefault('OPTIMIZE_LEVEL', 0)
+    app.after_request(_report)
@@ -0,0 +1,272 @@
+import json
+import math
+import mmap
+import os
+import shutil
+import subprocess
+from contextlib import contextmanager
+
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.errors import PdfReadError
+from PyPDF2.generic import ArrayObject, IndirectObject, NameObject, NumberObject
+
+import incremental
+import pools
+import profiling
+
+# Linearizing needs qpdf, through pikepdf when installed or the qpdf command
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+# Input files at least this large are memory-mapped rather than read through
+# a regular file object
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# Files smaller than this have their text extracted in the calling process
+# even when workers are asked for; shipping shards to a pool costs more than
+# extracting them
+MIN_PARALLEL_TEXT_BYTES = 1024 * 1024
+
+
+def is_path(source):
+    return isinstance(source, (str, os.PathLike))
+
+
+# Memory-map a file of at least threshold bytes; None when it is smaller or
+# cannot be mapped (empty files, special files, platforms without mmap)
+def _map_file(pdf_file, threshold):
+    try:
+        size = os.fstat(pdf_file.fileno()).st_size
+        if size == 0 or size < threshold:
+            return None
+        return mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+
+# Open a PDF given either as a path or as an in-memory buffer. Files of at
+# least mmap_threshold bytes are handed to the reader as a memory map, so
+# seeks and reads become page faults instead of syscalls and buffer copies.
+@contextmanager
+def open_source(source, mmap_threshold=None):
+    if mmap_threshold is None:
+        mmap_threshold = MMAP_THRESHOLD
+
+    if is_path(source):
+        with open(source, 'rb') as pdf_file:
+            mapped = _map_file(pdf_file, mmap_threshold)
+            if mapped is None:
+                yield pdf_file
+            else:
+                try:
+                    yield mapped
+                finally:
+                    mapped.close()
+    else:
+        source.seek(0)
+        yield source
+
+
+# Write to a path, or straight into a caller-provided buffer
+@contextmanager
+def open_output(output):
+    if is_path(output):
+        with open(output, 'wb') as output_file:
+            yield output_file
+    else:
+        yield output
+
+
+# Rotate every page by degree. Only /Rotate changes, so by default the new
+# page dictionaries are appended to the original bytes as an incremental
+# update; encrypted or damaged files, or rewrite=True, get a full rewrite.
+def rotate_pdf(pdf_source, degree, output, rewrite=False):
+    # Normalize degree to be between 0 and 360
+    degree = degree % 360
+
+    with open_source(pdf_source) as pdf_file:
+        with profiling.stage('parse'):
+            pdf_reader = PdfReader(pdf_file)
+            profiling.count('pages', len(pdf_reader.pages))
+
+        if not rewrite and incremental.can_update(pdf_reader, pdf_file):
+            updates = {}
+            if degree:
+                for page in pdf_reader.pages:
+                    ref = page.indirect_reference
+                    page[NameObject('/Rotate')] = NumberObject((int(page['/Rotate'] if '/Rotate' in page else 0) + degree) % 360)
+                    updates[(ref.idnum, ref.generation)] = page
+            with profiling.stage('write'), open_output(output) as output_file:
+                incremental.append_update(pdf_file, pdf_reader, updates, output_file)
+            return output
+
+        pdf_writer = PdfWriter()
+        with profiling.stage('add_page'):
+            for page in pdf_reader.pages:
+                # Get current rotation
+                current_rotation = page.get('/Rotate', 0)
+
+                # Calculate new rotation
+                new_rotation = (current_rotation + degree) % 360
+
+                # Set it on the page being copied
+                page[NameObject('/Rotate')] = NumberObject(new_rotation)
+                pdf_writer.add_page(page)
+
+        with profiling.stage('write'), open_output(output) as output_file:
+            pdf_writer.write(output_file)
+    return output
+
+
+# Forget the parsed content streams of a page the caller is done with, so
+# long documents don't keep every page's decoded content in memory
+def release_page(reader, page):
+    contents = page.get('/Contents')
+    refs = contents if isinstance(contents, ArrayObject) else [contents]
+    for ref in refs:
+        if isinstance(ref, IndirectObject):
+            reader.resolved_objects.pop((ref.generation, ref.idnum), None)
+
+
+# Yield (page number, text) one page at a time
+def iter_page_text(pdf_source):
+    with open_source(pdf_source) as pdf_file:
+        pdf_reader = PdfReader(pdf_file)
+        for i, page in enumerate(pdf_reader.pages):
+            text = page.extract_text()
+            release_page(pdf_reader, page)
+            yield i + 1, text
+
+
+# Worker side of a sharded extraction: open (or map) the file by path and
+# return the text of pages start..stop-1
+def _extract_shard(pdf_path, start, stop):
+    texts = []
+    with open_source(pdf_path) as pdf_file:
+        pdf_reader = PdfReader(pdf_file)
+        for i in range(start, stop):
+            page = pdf_reader.pages[i]
+            texts.append(page.extract_text())
+            release_page(pdf_reader, page)
+    return texts
+
+
+# Split the page range into shards, extract them in the shared worker pool
+# and yield (page number, text) in document order as shards complete
+def iter_page_text_parallel(pdf_path, workers=None, shard_size=None):
+    workers = workers or os.cpu_count() or 1
+    with open_source(pdf_path) as pdf_file:
+        num_pages = len(PdfReader(pdf_file).pages)
+    if not shard_size:
+        # A few shards per worker keeps the pool busy when pages vary in cost
+        shard_size = max(1, math.ceil(num_pages / (workers * 4)))
+
+    starts = list(range(0, num_pages, shard_size))
+    stops = [min(start + shard_size, num_pages) for start in starts]
+    shards = pools.executor(workers).map(_extract_shard, [pdf_path] * len(starts), starts, stops)
+    for start, texts in zip(starts, shards):
+        for offset, text in enumerate(texts):
+            yield start + offset + 1, text
+
+
+# Workers re-open the file by path, so in-memory sources are always read
+# serially, as are files under MIN_PARALLEL_TEXT_BYTES
+def _page_texts(pdf_source, workers=1, shard_size=None):
+    if workers == 1 or not is_path(pdf_source) or os.path.getsize(pdf_source) < MIN_PARALLEL_TEXT_BYTES:
+        return iter_page_text(pdf_source)
+    return iter_page_text_parallel(pdf_source, workers, shard_size)
+
+
+# Text of every page, concatenated; workers > 1 (or None for one per CPU)
+# spreads the pages of large enough files over worker processes
+def extract_text(pdf_source, workers=1, shard_size=None):
+    return "".join(text for _, text in _page_texts(pdf_source, workers, shard_size))
+
+
+# Write the text as UTF-8 to a path or buffer
+def extract_text_to_file(pdf_source, output, workers=1, shard_size=None):
+    with profiling.stage('extract'), open_output(output) as output_file:
+        for _, text in _page_texts(pdf_source, workers, shard_size):
+            output_file.write(text.encode('utf-8'))
+            profiling.count('pages', 1)
+    return output
+
+
+# Chunks for a streamed response: raw text, or one JSON object per page
+def stream_text(pdf_source, fmt='text', workers=1, shard_size=None):
+    for page_number, text in _page_texts(pdf_source, workers, shard_size):
+        if fmt == 'ndjson':
+            yield json.dumps({'page': page_number, 'text': text}) + "\n"
+        else:
+            yield text
+
+
+# Drop one page (1-based), rewriting the whole document so nothing of the
+# page is left in it. compact=False instead appends the page tree nodes above
+# it to the original bytes as an incremental update, which is faster but
+# leaves the page's content, images and fonts recoverable from the file;
+# encrypted or damaged files are always rewritten.
+def remove_page(pdf_source, page_number, output, compact=True):
+    with open_source(pdf_source) as pdf_file:
+        with profiling.stage('parse'):
+            pdf_reader = PdfReader(pdf_file)
+        profiling.count('pages', 1)
+
+        if not compact and incremental.can_update(pdf_reader, pdf_file):
+            try:
+                updates = incremental.remove_page_updates(pdf_reader, page_number - 1)
+            except IndexError:
+                updates = {}
+            except PdfReadError:
+                updates = None
+            if updates is not None:
+                with profiling.stage('write'), open_output(output) as output_file:
+                    incremental.append_update(pdf_file, pdf_reader, updates, output_file)
+                return output
+
+        pdf_writer = PdfWriter()
+        with profiling.stage('add_page'):
+            for i, page in enumerate(pdf_reader.pages):
+                if i != page_number - 1:
+                    pdf_writer.add_page(page)
+        profiling.count('pages', len(pdf_writer.pages))
+
+        with profiling.stage('write'), open_output(output) as output_file:
+            pdf_writer.write(output_file)
+    return output
+
+
+# Copy the listed pages (0-based) into a new PDF, skipping any out of range
+def extract_pages(input_pdf, page_numbers, output_pdf):
+    with open_source(input_pdf) as input_file:
+        with profiling.stage('parse'):
+            reader = PdfReader(input_file)
+        writer = PdfWriter()
+
+        with profiling.stage('add_page'):
+            for page_num in page_numbers:
+                if page_num < len(reader.pages):
+                    writer.add_page(reader.pages[page_num])
+        profiling.count('pages', len(writer.pages))
+
+        with profiling.stage('write'), open_output(output_pdf) as output_file:
+            writer.write(output_file)
+    return output_pdf
+
+
+def can_linearize():
+    return pikepdf is not None or shutil.which('qpdf') is not None
+
+
+# Rewrite a PDF as linearized ("fast web view"): the first page's objects and
+# hint tables come first, so a viewer making range requests can show page 1
+# after reading the start of the file. Raises when the input can't be parsed.
+def linearize(input_path, output_path):
+    if pikepdf is not None:
+        with pikepdf.open(input_path) as pdf:
+            pdf.save(output_path, linearize=True)
+    else:
+        subprocess.run(['qpdf', '--linearize', input_path, output_path], check=True, capture_output=True)
+    return output_path
@@ -0,0 +1,141 @@
+import io
+import zlib
+
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+
+# The pieces shared by the tools that write PDF files by hand (optimize,
+# merging, incremental): serializing objects, copying them out of a reader
+# with new numbers, and the cross-reference sections.
+#
+# Cross-reference entries are given as {idnum: (kind, field, index)}, in the
+# form of xref stream rows: (1, offset, generation) for an object written at
+# offset, (2, stream_id, index) for one packed into an object stream.
+
+
+def serialize(obj):
+    buffer = io.BytesIO()
+    obj.write_to_stream(buffer, None)
+    return buffer.getvalue()
+
+
+# Copies objects out of a reader, replacing every reference by one to the
+# number copy_ref(ref) gives the object it points at
+class ObjectCopier:
+    def copy_ref(self, ref):
+        raise NotImplementedError
+
+    def copy_value(self, value):
+        if isinstance(value, IndirectObject):
+            return IndirectObject(self.copy_ref(value), 0, None)
+        if isinstance(value, DictionaryObject):
+            copy = DictionaryObject()
+            for key, item in value.items():
+                copy[NameObject(key)] = self.copy_value(item)
+            return copy
+        if isinstance(value, ArrayObject):
+            return ArrayObject(self.copy_value(item) for item in value)
+        return value
+
+    # Copy of a resolved object; streams keep their encoded data and drop
+    # /Length, which is written from the data
+    def copy_object(self, obj):
+        if isinstance(obj, StreamObject):
+            copy = obj.__class__()
+            copy._data = obj._data
+            for name, item in obj.items():
+                if name != '/Length':
+                    copy[NameObject(name)] = self.copy_value(item)
+            return copy
+        return self.copy_value(obj)
+
+
+# Writes to a file while counting the bytes, for object offsets; position
+# starts where the file already is (an incremental update)
+class Output:
+    def __init__(self, output_file, position=0):
+        self.output_file = output_file
+        self.position = position
+
+    def write(self, data):
+        self.output_file.write(data)
+        self.position += len(data)
+
+    # Write an object and return its cross-reference entry
+    def write_object(self, idnum, data, generation=0):
+        offset = self.position
+        self.write(b"%d %d obj\n%s\nendobj\n" % (idnum, generation, data))
+        return (1, offset, generation)
+
+
+# Runs of consecutive object numbers, as (first, count) pairs
+def subsections(numbers):
+    runs = []
+    for idnum in numbers:
+        if runs and runs[-1][0] + runs[-1][1] == idnum:
+            runs[-1][1] += 1
+        else:
+            runs.append([idnum, 1])
+    return runs
+
+
+# Classic xref table and trailer for objects numbered below size. A whole
+# file gets one subsection from 0, numbers with no entry listed as free; an
+# update lists only its own objects, after the head of the free list.
+def write_xref_table(out, entries, size, trailer, update=False):
+    xref_position = out.position
+    out.write(b"xref\n")
+    if update:
+        out.write(b"0 1\n0000000000 65535 f \n")
+        runs = subsections(sorted(entries))
+    else:
+        out.write(b"0 %d\n0000000000 65535 f \n" % size)
+        runs = [(1, size - 1)]
+
+    for first, count in runs:
+        if update:
+            out.write(b"%d %d\n" % (first, count))
+        for idnum in range(first, first + count):
+            if idnum in entries:
+                kind, offset, generation = entries[idnum]
+                out.write(b"%010d %05d n \n" % (offset, generation))
+            else:
+                out.write(b"0000000000 00000 f \n")
+
+    trailer[NameObject('/Size')] = NumberObject(size)
+    out.write(b"trailer\n%s\nstartxref\n%d\n%%%%EOF\n" % (serialize(trailer), xref_position))
+
+
+# Xref stream for objects numbered below size, written as object number size
+# and listing itself; whole files and updates are covered as by
+# write_xref_table. zlib_level Flate-compresses the rows.
+def write_xref_stream(out, entries, size, trailer, update=False, zlib_level=None):
+    xref_id = size
+    xref_position = out.position
+    entries = dict(entries)
+    entries[xref_id] = (1, xref_position, 0)
+    size += 1
+
+    numbers = sorted(entries) if update else range(size)
+    width = max(1, (max(entry[1] for entry in entries.values()).bit_length() + 7) // 8)
+    rows = []
+    for idnum in numbers:
+        if idnum in entries:
+            kind, field, index = entries[idnum]
+        else:
+            kind, field, index = 0, 0, 0xffff if idnum == 0 else 0
+        rows.append(bytes([kind]) + field.to_bytes(width, 'big') + index.to_bytes(2, 'big'))
+
+    xref = StreamObject()
+    xref._data = b"".join(rows)
+    xref.update(trailer)
+    xref[NameObject('/Type')] = NameObject('/XRef')
+    xref[NameObject('/Size')] = NumberObject(size)
+    xref[NameObject('/W')] = ArrayObject([NumberObject(1), NumberObject(width), NumberObject(2)])
+    if update:
+        xref[NameObject('/Index')] = ArrayObject(
+            NumberObject(value) for run in subsections(numbers) for value in run)
+    if zlib_level is not None:
+        xref._data = zlib.compress(xref._data, zlib_level)
+        xref[NameObject('/Filter')] = NameObject('/FlateDecode')
+    out.write_object(xref_id, serialize(xref))
+    out.write(b"startxref\n%d\n%%%%EOF\n" % xref_position)
@@ -0,0 +1,23 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Process pools shared by every request of a process, one per worker count,
+# started on first use and kept for the process's lifetime. Workers come from
+# a fork server where there is one, so they aren't forked from a server
+# thread while other threads hold locks (logging, sqlite).
+_executors = {}
+_lock = threading.Lock()
+
+
+def _context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return None
+
+
+def executor(workers):
+    with _lock:
+        if workers not in _executors:
+            _executors[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=_context())
+        return _executors[workers]
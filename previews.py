@@ -0,0 +1,208 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import threading
+import uuid
+
+from flask import Blueprint, abort, current_app, jsonify, request, send_file
+from PyPDF2.errors import PdfReadError
+from werkzeug.security import safe_join
+
+import metadata
+
+# Rasterizers are optional: PyMuPDF when installed, else poppler's pdftoppm.
+# Without either, preview routes answer 503 and viewers fall back to
+# rendering in the browser.
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+blueprint = Blueprint('previews', __name__)
+
+MIMETYPES = {'png': 'image/png', 'webp': 'image/webp'}
+
+# Share of max_bytes the cache is evicted down to once it goes over, so a
+# full cache isn't rescanned on every new tile
+EVICT_TO = 0.9
+
+
+# Directory of rendered files that evicts the least recently used ones once
+# their total size goes over max_bytes (down to EVICT_TO of it)
+class PreviewCache:
+    def __init__(self, directory, max_bytes):
+        # Absolute, as send_file resolves relative paths against the app's root
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    # Path of the cached file, writing build() to it first if there is none;
+    # hits bump the file's mtime, which is the eviction order
+    def get_or_create(self, key, extension, build):
+        path = self.path(key, extension)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        data = build()
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    def _evict(self, keep):
+        entries = [entry for entry in os.scandir(self.directory)
+                   if entry.is_file() and not entry.name.endswith('.tmp') and entry.path != keep]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries) + os.path.getsize(keep)
+        for entry in entries:
+            if self.size <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.size -= size
+            except FileNotFoundError:
+                pass
+
+
+def renderer():
+    if pymupdf is not None:
+        return 'pymupdf'
+    if shutil.which('pdftoppm'):
+        return 'pdftoppm'
+    return None
+
+
+def formats():
+    return ['png', 'webp'] if Image is not None else ['png']
+
+
+# PNG of one page (1-based) at scale times its size in points
+def _render_png(pdf_path, page_number, scale):
+    if pymupdf is not None:
+        with pymupdf.open(pdf_path) as document:
+            pixmap = document[page_number - 1].get_pixmap(matrix=pymupdf.Matrix(scale, scale), alpha=False)
+            return pixmap.tobytes('png')
+
+    result = subprocess.run(
+        ['pdftoppm', '-f', str(page_number), '-l', str(page_number), '-r', f"{72 * scale:g}",
+         '-png', pdf_path],
+        capture_output=True, check=True)
+    if not result.stdout:
+        raise IndexError(f"page {page_number} out of range")
+    return result.stdout
+
+
+def render_page(pdf_path, page_number, scale, fmt):
+    data = _render_png(pdf_path, page_number, scale)
+    if fmt == 'webp':
+        buffer = io.BytesIO()
+        Image.open(io.BytesIO(data)).save(buffer, 'WEBP', quality=80)
+        data = buffer.getvalue()
+    return data
+
+
+# Page count and the displayed size of each page in points (rotation
+# applied), from the document's metadata index entry
+def document_info(info):
+    sizes = []
+    for page in info['page_info']:
+        x0, y0, x1, y1 = page['mediabox']
+        width, height = abs(x1 - x0), abs(y1 - y0)
+        if page['rotate'] % 180:
+            width, height = height, width
+        sizes.append([round(width, 2), round(height, 2)])
+    return {'pages': info['pages'], 'sizes': sizes}
+
+
+# Attach a preview cache and the preview routes to an app
+def init_app(app):
+    app.config.setdefault('PREVIEW_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'previews'))
+    app.config.setdefault('PREVIEW_CACHE_BYTES', 256 * 1024 * 1024)
+    # Scales a page can be rendered at; other values are refused so the
+    # cache holds a bounded number of variants per page
+    app.config.setdefault('PREVIEW_SCALES', (0.25, 0.5, 1.0, 1.5, 2.0))
+
+    if 'metadata' not in app.extensions:
+        metadata.init_app(app)
+    app.extensions['previews'] = PreviewCache(app.config['PREVIEW_FOLDER'], app.config['PREVIEW_CACHE_BYTES'])
+    app.register_blueprint(blueprint)
+
+
+# Path of an uploaded PDF and a cache key prefix that changes with its content
+def _source(filename):
+    path = safe_join(current_app.config['UPLOAD_FOLDER'], filename)
+    if path is None or not os.path.isfile(path):
+        abort(404, description="File not found")
+    stat = os.stat(path)
+    version = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+    return path, hashlib.sha256(version.encode()).hexdigest()
+
+
+# Page count, page sizes and what the server can render for an uploaded
+# file; aborts with 404 when there is no such upload, or it isn't a PDF
+def preview_info(filename):
+    path, version = _source(filename)
+    cache = current_app.extensions['previews']
+    try:
+        info_path = cache.get_or_create(f"{version}-info", 'json',
+                                        lambda: json.dumps(document_info(metadata.index_file(path))).encode())
+    except PdfReadError:
+        abort(404, description="File not found")
+    with open(info_path, encoding='utf-8') as info_file:
+        info = json.load(info_file)
+
+    info['renderer'] = renderer()
+    info['formats'] = formats() if info['renderer'] else []
+    info['scales'] = list(current_app.config['PREVIEW_SCALES'])
+    return info
+
+
+@blueprint.route('/preview/<filename>/info')
+def preview_info_json(filename):
+    return jsonify(preview_info(filename))
+
+
+# One page (1-based) rasterized at ?scale=, rendered on first request
+@blueprint.route('/preview/<filename>/<int:page_number>.<fmt>')
+def preview_page(filename, page_number, fmt):
+    if fmt not in formats() or page_number < 1:
+        abort(404, description="Preview not found")
+    scale = request.args.get('scale', 1.0, type=float)
+    if scale not in current_app.config['PREVIEW_SCALES']:
+        abort(400, description="Unsupported preview scale")
+    if renderer() is None:
+        abort(503, description="No PDF rasterizer is installed on the server")
+
+    path, version = _source(filename)
+    cache = current_app.extensions['previews']
+    key = f"{version}-{page_number}-{scale:g}"
+    try:
+        tile = cache.get_or_create(key, fmt, lambda: render_page(path, page_number, scale, fmt))
+    except (IndexError, ValueError, RuntimeError, subprocess.CalledProcessError):
+        # pymupdf raises FileDataError, a RuntimeError, for files that
+        # aren't PDFs
+        abort(404, description="Page not found")
+
+    return send_file(tile, mimetype=MIMETYPES[fmt], max_age=3600)
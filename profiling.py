@@ -0,0 +1,261 @@
+import cProfile
+import os
+import resource
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, current_app, g, has_request_context, request
+
+blueprint = Blueprint('profiling', __name__)
+
+# Upper bounds of the duration histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIX = 'pdf_tools_'
+
+HELP = {
+    'requests_total': ('counter', "Requests handled, by endpoint, method and status"),
+    'request_duration_seconds': ('histogram', "Time from the start of a request until its response was sent"),
+    'stage_duration_seconds': ('histogram', "Time spent in each stage of a request"),
+    'request_bytes_read_total': ('counter', "Request body bytes received"),
+    'response_bytes_written_total': ('counter', "Response body bytes sent"),
+    'pages_processed_total': ('counter', "PDF pages read or written by the tools"),
+    'request_peak_rss_bytes': ('gauge', "Largest peak resident set size seen during one request"),
+}
+
+
+def _labels(labels):
+    return ",".join(f'{key}="{value}"' for key, value in labels)
+
+
+# Counters, gauges and histograms of one process, rendered in the Prometheus
+# text format; each worker process of a multi-process server keeps its own
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set_max(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.values[key] = max(self.values.get(key, 0), value)
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts = self.histograms.setdefault(key, [0] * len(BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        with self._lock:
+            values = sorted(self.values.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                kind, text = HELP.get(name, ('untyped', name))
+                lines.append(f"# HELP {PREFIX}{name} {text}")
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for (name, labels), value in values:
+            describe(name)
+            lines.append(f"{PREFIX}{name}{{{_labels(labels)}}} {value}")
+        for (name, labels), counts in histograms:
+            describe(name)
+            for bound, count in zip(BUCKETS, counts):
+                lines.append(f"{PREFIX}{name}_bucket{{{_labels(labels + (('le', bound),))}}} {count}")
+            lines.append(f"{PREFIX}{name}_bucket{{{_labels(labels + (('le', '+Inf'),))}}} {counts[-1]}")
+            lines.append(f"{PREFIX}{name}_sum{{{_labels(labels)}}} {counts[-2]:.6f}")
+            lines.append(f"{PREFIX}{name}_count{{{_labels(labels)}}} {counts[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+# Stage timings and counts gathered while one request is handled
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+
+    def add_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def server_timing(self):
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        entries.append(f"app;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+def _profile():
+    return g.get('profile') if has_request_context() else None
+
+
+# Time a block as a stage of the current request; repeated stages add up.
+# Outside a request (scripts, job worker processes) this does nothing.
+@contextmanager
+def stage(name):
+    profile = _profile()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.add_time(name, time.perf_counter() - started)
+
+
+# Add to a count of the current request, such as the pages it processed
+def count(name, value):
+    profile = _profile()
+    if profile is not None:
+        profile.add_count(name, value)
+
+
+# Record stage timings measured elsewhere, as {stage: seconds}
+def add_timings(timings):
+    profile = _profile()
+    if profile is not None:
+        for name, seconds in timings.items():
+            profile.add_time(name, seconds)
+
+
+# Reset the process's peak RSS so the next reading covers one request
+# (Linux); concurrent requests in the same process share the reading
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _instrumented():
+    return request.endpoint is not None and request.endpoint not in ('profiling.metrics', 'static')
+
+
+def _start_request():
+    if not _instrumented():
+        return
+    g.profile = RequestProfile()
+    reset_peak_rss()
+    if current_app.config['PROFILE_REQUESTS'] and request.args.get('profile'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+    # Multipart bodies are parsed (and spooled) as the upload stage
+    if request.method == 'POST' and request.mimetype == 'multipart/form-data':
+        with stage('upload'):
+            request.files
+
+
+def _save_profile(profiler):
+    profiler.disable()
+    folder = current_app.config['PROFILE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    filename = f"{request.endpoint}-{uuid.uuid4().hex}.prof"
+    profiler.dump_stats(os.path.join(folder, filename))
+    return filename
+
+
+def _counted(chunks, sent):
+    try:
+        for chunk in chunks:
+            sent[0] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _finish_request(response):
+    profile = g.get('profile')
+    if profile is None:
+        return response
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        response.headers['X-Profile'] = _save_profile(profiler)
+    response.headers['Server-Timing'] = profile.server_timing()
+
+    # Streamed bodies are counted as they go out
+    sent = [response.content_length]
+    if sent[0] is None and not response.direct_passthrough:
+        sent[0] = 0
+        response.response = _counted(response.response, sent)
+
+    metrics = current_app.extensions['metrics']
+    endpoint = request.endpoint
+    method = request.method
+    bytes_read = request.content_length or 0
+    sending = time.perf_counter()
+
+    def record():
+        now = time.perf_counter()
+        if not response.direct_passthrough:
+            profile.add_time('send', now - sending)
+        route = {'endpoint': endpoint}
+        metrics.inc('requests_total', {'endpoint': endpoint, 'method': method, 'status': response.status_code})
+        metrics.observe('request_duration_seconds', route, now - profile.started)
+        for name, seconds in profile.stages.items():
+            metrics.observe('stage_duration_seconds', {'endpoint': endpoint, 'stage': name}, seconds)
+        metrics.inc('request_bytes_read_total', route, bytes_read)
+        metrics.inc('response_bytes_written_total', route, sent[0] or 0)
+        metrics.inc('pages_processed_total', route, profile.counts.get('pages', 0))
+        metrics.set_max('request_peak_rss_bytes', route, peak_rss())
+
+    # Werkzeug hands passthrough bodies (send_file) to the server without
+    # calling the response's close hooks, so those are recorded before
+    # sending; everything else once the body has gone out
+    if response.direct_passthrough:
+        record()
+    else:
+        response.call_on_close(record)
+    return response
+
+
+# Time every request to an app, report its stages in a Server-Timing header
+# and collect process metrics for /metrics. With PROFILE_REQUESTS set, a
+# request with ?profile=1 also runs under cProfile and the stats file's name
+# comes back in X-Profile.
+def init_app(app):
+    app.config.setdefault('PROFILE_REQUESTS', False)
+    output_folder = app.config.get('OUTPUT_FOLDER', app.config['UPLOAD_FOLDER'])
+    app.config.setdefault('PROFILE_FOLDER', os.path.join(output_folder, 'profiles'))
+    app.extensions['metrics'] = Metrics()
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.register_blueprint(blueprint)
+
+
+@blueprint.route('/metrics')
+def metrics():
+    return Response(current_app.extensions['metrics'].render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,224 @@
+import io
+import math
+import os
+import zipfile
+
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2._page import PageObject
+from PyPDF2.errors import PdfReadError
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject
+
+import pools
+import profiling
+from pdf_tools import is_path, open_output, open_source
+
+# Page attributes a page inherits from its ancestors in the page tree
+INHERITABLE = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+# Files smaller than this are split in the calling process even when workers
+# are configured; handing them to a pool costs more than writing the outputs
+MIN_PARALLEL_BYTES = 4 * 1024 * 1024
+
+
+def _is_leaf(node):
+    return node.get('/Type') == '/Page' or '/Kids' not in node
+
+
+def _leaf_count(node):
+    return 1 if _is_leaf(node) else node.get('/Count', 0)
+
+
+# Find page index (0-based) by descending the page tree along /Count, so only
+# the nodes on the path to the page are resolved, not the whole page list
+def page_at(reader, index):
+    ref = reader.trailer['/Root'].raw_get('/Pages')
+    node = ref.get_object()
+    if not 0 <= index < node.get('/Count', 0):
+        raise IndexError(f"page index {index} out of range")
+    inherited = {}
+
+    while not _is_leaf(node):
+        for key in INHERITABLE:
+            if key in node:
+                inherited[key] = node.raw_get(key)
+
+        kids = node['/Kids']
+        kid = None
+        # When /Count equals the number of kids every kid is usually a page,
+        # so the page can be picked without resolving its siblings
+        if node.get('/Count') == len(kids) and index < len(kids):
+            kid = kids[index]
+            if _is_leaf(kid.get_object()):
+                index = 0
+            else:
+                kid = None
+
+        if kid is None:
+            for candidate in kids:
+                count = _leaf_count(candidate.get_object())
+                if index < count:
+                    kid = candidate
+                    break
+                index -= count
+            else:
+                raise PdfReadError("page tree /Count does not match its kids")
+
+        ref, node = kid, kid.get_object()
+
+    page = PageObject(reader, ref if isinstance(ref, IndirectObject) else None)
+    page.update(node)
+    for key, value in inherited.items():
+        if key not in page:
+            page[NameObject(key)] = value
+    return page
+
+
+# Copy pages start_page..end_page (1-based, inclusive), resolving only the
+# objects those pages reference; returns counts for the caller to report
+def split_range(pdf_source, start_page, end_page, output):
+    with open_source(pdf_source) as pdf_file:
+        with profiling.stage('parse'):
+            reader = PdfReader(pdf_file)
+        writer = PdfWriter()
+
+        with profiling.stage('add_page'):
+            for page_num in range(start_page - 1, end_page):
+                try:
+                    page = page_at(reader, page_num)
+                except PdfReadError:
+                    # Broken /Count values: fall back to the reader's full page list
+                    page = reader.pages[page_num]
+                writer.add_page(page)
+        profiling.count('pages', len(writer.pages))
+
+        with profiling.stage('write'), open_output(output) as output_file:
+            writer.write(output_file)
+
+        return {
+            'pages': max(0, end_page - start_page + 1),
+            'objects_read': len(reader.resolved_objects),
+            'objects_in_file': reader.trailer.get('/Size', 0),
+        }
+
+
+# Page ranges from "1-3, 4-10, 11" (1-based, inclusive), one output per item
+def parse_ranges(spec):
+    ranges = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        start, _, end = item.partition('-')
+        start = int(start)
+        end = int(end) if end else start
+        if start < 1 or end < start:
+            raise ValueError(f"invalid page range {item!r}")
+        ranges.append((start, end))
+    if not ranges:
+        raise ValueError("no page ranges given")
+    return ranges
+
+
+# Consecutive ranges of every pages each, covering the whole document
+def every_n_pages(num_pages, every):
+    if every < 1:
+        raise ValueError("every must be at least 1")
+    return [(start, min(start + every - 1, num_pages)) for start in range(1, num_pages + 1, every)]
+
+
+def _write_pages(pages):
+    writer = PdfWriter()
+    for page in pages:
+        writer.add_page(page)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+# Worker side: open (or map) the file by path, parsing it once for a whole
+# batch of ranges, and return the bytes of each range's output
+def _write_batch(pdf_path, ranges):
+    with open_source(pdf_path) as pdf_file:
+        reader = PdfReader(pdf_file)
+        pages = {}
+        outputs = []
+        for start, end in ranges:
+            for page_num in range(start - 1, end):
+                if page_num not in pages:
+                    pages[page_num] = page_at(reader, page_num)
+            outputs.append(_write_pages([pages[i] for i in range(start - 1, end)]))
+        return outputs
+
+
+# True when the outputs are worth writing in worker processes, which open
+# the file by path; in-memory sources are always split in this process
+def _parallel(pdf_source, ranges, workers):
+    return workers > 1 and len(ranges) > 1 and is_path(pdf_source) and \
+        os.path.getsize(pdf_source) >= MIN_PARALLEL_BYTES
+
+
+# Bytes of each output, in order. Large files are split by the shared pool,
+# each worker taking one run of consecutive ranges so it parses the file
+# once; everything else is written here from the reader already open.
+def _render_ranges(pdf_source, reader, ranges, workers):
+    if _parallel(pdf_source, ranges, workers):
+        size = math.ceil(len(ranges) / workers)
+        batches = [ranges[i:i + size] for i in range(0, len(ranges), size)]
+        for outputs in pools.executor(workers).map(_write_batch, [pdf_source] * len(batches), batches):
+            yield from outputs
+        return
+
+    pages = {}
+    for start, end in ranges:
+        for page_num in range(start - 1, end):
+            if page_num not in pages:
+                pages[page_num] = page_at(reader, page_num)
+        yield _write_pages([pages[i] for i in range(start - 1, end)])
+
+
+# File-like sink for zipfile that hands out what has been written so far
+class _ZipChunks:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# Yield a ZIP, chunk by chunk, holding one PDF per range; pass ranges, or
+# every to cut the document every N pages
+def iter_split_zip(pdf_source, ranges=None, every=None, workers=None):
+    workers = workers or os.cpu_count() or 1
+    with open_source(pdf_source) as pdf_file:
+        reader = PdfReader(pdf_file)
+        num_pages = reader.trailer['/Root']['/Pages'].get('/Count', 0)
+        if every:
+            ranges = every_n_pages(num_pages, every)
+        for start, end in ranges:
+            if end > num_pages:
+                raise IndexError(f"page range {start}-{end} is past the last page ({num_pages})")
+
+        sink = _ZipChunks()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+            width = len(str(len(ranges)))
+            outputs = _render_ranges(pdf_source, reader, ranges, workers)
+            for index, ((start, end), data) in enumerate(zip(ranges, outputs)):
+                archive.writestr(f"part_{index + 1:0{width}d}_pages_{start}-{end}.pdf", data)
+                yield sink.take()
+        yield sink.take()
+
+
+def split_to_zip(pdf_source, ranges, every, output, workers=None):
+    with open_output(output) as output_file:
+        for chunk in iter_split_zip(pdf_source, ranges, every, workers):
+            output_file.write(chunk)
+    return output
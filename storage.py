@@ -0,0 +1,250 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import uuid
+
+from flask import current_app
+
+import optimize
+import profiling
+from uploads import UploadStream
+
+# Bytes read from an upload stream per iteration
+CHUNK_SIZE = 1024 * 1024
+
+# Once a store directory goes over its byte budget, its least recently used
+# files are removed until it is back under this share of the budget, so the
+# next few writes don't each have to scan it again
+EVICT_TO = 0.9
+
+# Bump when a tool's output changes so stale cached results are not reused
+RESULT_VERSION = 5
+
+
+def _stored_files(directory):
+    for subdir in os.scandir(directory):
+        if subdir.is_dir():
+            for entry in os.scandir(subdir.path):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    yield entry
+
+
+# Content-addressed store: uploads live under the SHA-256 of their bytes and
+# results under a key derived from (operation, input hashes, parameters).
+# Each directory keeps to a byte budget (None: unlimited) by evicting its
+# least recently used files; hits bump a file's mtime, which is that order.
+class Store:
+    def __init__(self, upload_dir, result_dir, upload_max_bytes=None, result_max_bytes=None):
+        # Absolute, since send_file resolves relative paths against the app's
+        # root rather than the working directory the folders were made in
+        self.upload_dir = os.path.abspath(upload_dir)
+        self.result_dir = os.path.abspath(result_dir)
+        os.makedirs(upload_dir, exist_ok=True)
+        os.makedirs(result_dir, exist_ok=True)
+        self.max_bytes = {self.upload_dir: upload_max_bytes, self.result_dir: result_max_bytes}
+        self.sizes = {directory: sum(entry.stat().st_size for entry in _stored_files(directory))
+                      for directory in self.max_bytes}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    # Account for a file just stored in directory, evicting older ones when
+    # that takes the directory over its budget
+    def _added(self, directory, path):
+        max_bytes = self.max_bytes[directory]
+        with self._lock:
+            self.sizes[directory] += os.path.getsize(path)
+            if max_bytes is not None and self.sizes[directory] > max_bytes:
+                self._evict(directory, keep=path, target=max_bytes * EVICT_TO)
+
+    def _evict(self, directory, keep, target):
+        entries = [entry for entry in _stored_files(directory) if entry.path != keep]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        size = sum(entry.stat().st_size for entry in entries) + os.path.getsize(keep)
+        for entry in entries:
+            if size <= target:
+                break
+            try:
+                entry_size = entry.stat().st_size
+                os.remove(entry.path)
+                size -= entry_size
+            except FileNotFoundError:
+                pass
+        self.sizes[directory] = size
+
+    def upload_path(self, digest, extension='.pdf'):
+        return os.path.join(self.upload_dir, digest[:2], f"{digest}{extension}")
+
+    # Write a stream to disk while hashing it, keeping one copy per content.
+    # Streams of at most memory_limit bytes are kept in memory instead and
+    # returned as a buffer in place of a path.
+    def save_stream(self, stream, extension='.pdf', memory_limit=0):
+        sha256 = hashlib.sha256()
+        head = b""
+        if memory_limit:
+            head = stream.read(memory_limit + 1)
+            sha256.update(head)
+            if len(head) <= memory_limit:
+                return sha256.hexdigest(), io.BytesIO(head)
+
+        tmp_path = os.path.join(self.upload_dir, f".{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'wb') as tmp_file:
+                tmp_file.write(head)
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    tmp_file.write(chunk)
+
+            digest = sha256.hexdigest()
+            path = self.upload_path(digest, extension)
+            if self._touch(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+                self._added(self.upload_dir, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest, path
+
+    # Store an UploadStream, which hashed its content as it arrived, so it is
+    # not read again; uploads already spilled to disk are moved into place
+    def save_upload_stream(self, stream, extension='.pdf', memory_limit=0):
+        digest = stream.hexdigest()
+        if stream.path is None and stream.size <= memory_limit:
+            return digest, stream.take_buffer()
+
+        path = self.upload_path(digest, extension)
+        if not self._touch(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = os.path.join(self.upload_dir, f".{uuid.uuid4().hex}.tmp")
+            stream.move_to(tmp_path)
+            os.replace(tmp_path, path)
+            self._added(self.upload_dir, path)
+        return digest, path
+
+    @staticmethod
+    def result_key(operation, digests, params):
+        payload = json.dumps([RESULT_VERSION, operation, list(digests), params], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def result_path(self, key, extension):
+        return os.path.join(self.result_dir, key[:2], f"{key}{extension}")
+
+    # Path of the cached result, or None when it hasn't been built
+    def lookup(self, key, extension):
+        path = self.result_path(key, extension)
+        return path if self._touch(path) else None
+
+    # Path of the cached result, running build(path) first if there is none;
+    # results are written to a temporary file and renamed into place
+    def get_or_create(self, key, extension, build):
+        path = self.result_path(key, extension)
+        if self._touch(path):
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            build(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._added(self.result_dir, path)
+        return path
+
+
+# Attach a store to an app, under its upload and output folders
+def init_app(app):
+    output_folder = app.config.get('OUTPUT_FOLDER', app.config['UPLOAD_FOLDER'])
+    app.config.setdefault('UPLOAD_STORE', os.path.join(app.config['UPLOAD_FOLDER'], 'sha256'))
+    app.config.setdefault('RESULT_STORE', os.path.join(output_folder, 'results'))
+    # Uploads up to this many bytes are processed in memory, never writing to
+    # the store or the result cache; 0 sends every upload to disk
+    app.config.setdefault('IN_MEMORY_THRESHOLD', 5 * 1024 * 1024)
+    # Byte budgets of the two stores (None: unlimited)
+    app.config.setdefault('UPLOAD_STORE_BYTES', 2 * 1024 ** 3)
+    app.config.setdefault('RESULT_STORE_BYTES', 2 * 1024 ** 3)
+    app.extensions['store'] = Store(app.config['UPLOAD_STORE'], app.config['RESULT_STORE'],
+                                    app.config['UPLOAD_STORE_BYTES'], app.config['RESULT_STORE_BYTES'])
+
+
+# Save an uploaded file into the current app's store; returns (digest, source)
+# where source is a path, or a buffer for uploads under memory_limit bytes
+# (IN_MEMORY_THRESHOLD unless given)
+def save_upload(file, memory_limit=None):
+    extension = os.path.splitext(file.filename)[1].lower() or '.pdf'
+    if memory_limit is None:
+        memory_limit = current_app.config['IN_MEMORY_THRESHOLD']
+    store = current_app.extensions['store']
+    with profiling.stage('store'):
+        if isinstance(file.stream, UploadStream):
+            file.stream.check()
+            return store.save_upload_stream(file.stream, extension, memory_limit)
+        return store.save_stream(file.stream, extension, memory_limit)
+
+
+# Save several uploads that are processed together, sharing one
+# IN_MEMORY_THRESHOLD budget so many small files cannot add up to an
+# unbounded amount of memory; returns (digests, sources)
+def save_uploads(files):
+    budget = current_app.config['IN_MEMORY_THRESHOLD']
+    digests = []
+    sources = []
+    for file in files:
+        digest, source = save_upload(file, budget)
+        if in_memory(source):
+            budget -= len(source.getbuffer())
+        digests.append(digest)
+        sources.append(source)
+    return digests, sources
+
+
+# True when every source is an in-memory buffer rather than a stored file
+def in_memory(*sources):
+    return all(isinstance(source, io.BytesIO) for source in sources)
+
+
+# Cached output of operation on the given inputs, built with build(output) on
+# a miss. Buffered (in-memory) inputs reuse a cached result when there is
+# one, but a miss is built into a buffer and never written to the cache.
+# PDFs go through the optimization stage when a level is asked for, and are
+# cached per level.
+def cached_result(operation, digests, params, extension, build, buffered=False):
+    level = optimize.requested_level() if extension == '.pdf' else 0
+    if level:
+        params = dict(params, optimize=level)
+        build = optimize.optimized(build, level)
+
+    store = current_app.extensions['store']
+    key = store.result_key(operation, digests, params)
+    if buffered:
+        cached = store.lookup(key, extension)
+        if cached is not None:
+            return cached
+        buffer = io.BytesIO()
+        build(buffer)
+        buffer.seek(0)
+        return buffer
+    return store.get_or_create(key, extension, build)
+
+
+# Text of a cached text result, given as a path or a buffer
+def read_text(result):
+    if isinstance(result, io.BytesIO):
+        return result.getvalue().decode('utf-8')
+    with open(result, encoding='utf-8') as text_file:
+        return text_file.read()
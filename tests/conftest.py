@@ -0,0 +1,26 @@
+import io
+import os
+import sys
+
+import pytest
+from PyPDF2 import PdfWriter
+
+# The tools are top-level modules of the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# A PDF with a classic xref table and the given number of blank pages, each
+# of a different width so pages can be told apart after a round trip
+def make_pdf(pages):
+    writer = PdfWriter()
+    for number in range(pages):
+        writer.add_blank_page(width=100 + number, height=200)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.fixture
+def pdf():
+    return make_pdf
@@ -0,0 +1,124 @@
+import io
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import DictionaryObject, IndirectObject, NameObject, NumberObject
+
+import incremental
+import merging
+import optimize
+from pdf_writing import Output, serialize, write_xref_stream, write_xref_table
+
+HEADER = b"%PDF-1.7\n"
+
+
+# Read data back, checking every in-use entry of the cross-reference
+# sections points exactly at its object (PyPDF2 quietly tolerates offsets
+# that are slightly off); free entries are kept with offset 0
+def _read(data):
+    reader = PdfReader(io.BytesIO(data), strict=True)
+    for generation, offsets in reader.xref.items():
+        for idnum, offset in offsets.items():
+            if offset:
+                assert data[offset:].startswith(b"%d %d obj" % (idnum, generation)), idnum
+    return reader
+
+
+def _widths(reader):
+    return [float(page.mediabox.width) for page in reader.pages]
+
+
+# A catalog, a page tree and one page, numbered with a gap at 2
+def _write_objects(out):
+    entries = {
+        1: out.write_object(1, b"<< /Type /Catalog /Pages 3 0 R >>"),
+        3: out.write_object(3, b"<< /Type /Pages /Kids [4 0 R] /Count 1 >>"),
+        4: out.write_object(4, b"<< /Type /Page /Parent 3 0 R /MediaBox [0 0 100 200] >>"),
+    }
+    trailer = DictionaryObject({NameObject('/Root'): IndirectObject(1, 0, None)})
+    return entries, trailer
+
+
+def test_xref_table_lists_gaps_as_free():
+    buffer = io.BytesIO()
+    out = Output(buffer)
+    out.write(HEADER)
+    entries, trailer = _write_objects(out)
+    write_xref_table(out, entries, 5, trailer)
+
+    data = buffer.getvalue()
+    assert out.position == len(data)
+    assert b"xref\n0 5\n0000000000 65535 f \n" in data
+    reader = _read(data)
+    assert _widths(reader) == [100]
+    assert reader.trailer['/Size'] == 5
+
+
+def test_xref_stream_round_trips():
+    for zlib_level in (None, 6):
+        buffer = io.BytesIO()
+        out = Output(buffer)
+        out.write(HEADER)
+        entries, trailer = _write_objects(out)
+        write_xref_stream(out, entries, 5, trailer, zlib_level=zlib_level)
+
+        reader = _read(buffer.getvalue())
+        assert _widths(reader) == [100]
+        # The stream lists itself as object 5; 2 stays free
+        assert sorted(reader.xref[0]) == [1, 3, 4, 5]
+
+
+def test_optimize_round_trips_both_xref_forms(pdf):
+    for level in optimize.LEVELS:
+        output = io.BytesIO()
+        stats = optimize.optimize_pdf(pdf(5), output, level)
+        data = output.getvalue()
+        assert stats['bytes_out'] == len(data)
+        assert (b"/XRef" in data) == optimize.LEVELS[level]['object_streams']
+        assert _widths(_read(data)) == [100, 101, 102, 103, 104]
+
+
+def test_merge_round_trips(pdf):
+    output = io.BytesIO()
+    stats = merging.merge_pdfs([pdf(2), pdf(3)], output)
+    assert stats['pages'] == 5
+    assert _widths(_read(output.getvalue())) == [100, 101, 100, 101, 102]
+
+
+def _remove_second_page(source):
+    reader = PdfReader(source)
+    updates = incremental.remove_page_updates(reader, 1)
+    output = io.BytesIO()
+    incremental.append_update(source, reader, updates, output)
+    return output.getvalue()
+
+
+def test_incremental_update_of_xref_table(pdf):
+    source = pdf(3)
+    original = source.getvalue()
+    data = _remove_second_page(source)
+
+    assert data.startswith(original)
+    reader = _read(data)
+    assert _widths(reader) == [100, 102]
+    assert reader.trailer['/Prev'] == incremental.last_xref(io.BytesIO(original))[0]
+
+
+def test_incremental_update_of_xref_stream(pdf):
+    source = io.BytesIO()
+    optimize.optimize_pdf(pdf(3), source, 2)
+    original = source.getvalue()
+    source.seek(0)
+    data = _remove_second_page(source)
+
+    assert data.startswith(original)
+    assert incremental.last_xref(io.BytesIO(data))[1]
+    reader = _read(data)
+    assert _widths(reader) == [100, 102]
+    # The update's objects, including the stream itself, are found after the
+    # original bytes
+    assert any(offset >= len(original) for offset in reader.xref[0].values())
+
+
+def test_serialize():
+    value = DictionaryObject({NameObject('/Count'): NumberObject(3)})
+    assert serialize(value) == b"<<\n/Count 3\n>>"
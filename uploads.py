@@ -0,0 +1,184 @@
+import hashlib
+import io
+import os
+import shutil
+import uuid
+
+from flask import Request, current_app
+from werkzeug.exceptions import BadRequest, UnsupportedMediaType
+
+# A PDF's %PDF- header must start within its first HEADER_WINDOW bytes. Its
+# %%EOF marker is looked for in the last TRAILER_WINDOW bytes, kept as the
+# upload arrives, and only when it isn't there (padding or junk after the
+# marker, which PDF readers accept) is the rest searched backwards.
+HEADER_WINDOW = 1024
+TRAILER_WINDOW = 1024
+
+# Bytes read at a time when searching an upload backwards for %%EOF
+SEARCH_CHUNK_SIZE = 1024 * 1024
+
+
+# Bytes the uploads of one request may hold in memory between them; an
+# upload that would go over spills to disk and gives its share back
+class MemoryBudget:
+    def __init__(self, limit):
+        self.remaining = limit
+
+    def take(self, size):
+        if size > self.remaining:
+            return False
+        self.remaining -= size
+        return True
+
+    def give_back(self, size):
+        self.remaining += size
+
+
+# Where the multipart parser writes an uploaded file as it arrives: memory
+# while budget (a MemoryBudget, shared by the request's uploads) allows, then
+# a temporary file in directory. The content is hashed on the way in, and a
+# body that doesn't start like a PDF is refused as soon as its first kilobyte
+# has been seen, so the rest is never read.
+class UploadStream(io.RawIOBase):
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.tail = b""
+        self.path = None
+        self._file = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        if len(self.head) < HEADER_WINDOW:
+            self.head += data[:HEADER_WINDOW - len(self.head)]
+            if len(self.head) == HEADER_WINDOW and b"%PDF-" not in self.head:
+                raise UnsupportedMediaType("Uploaded file is not a PDF")
+        self.tail = (self.tail + data)[-TRAILER_WINDOW:]
+        self.sha256.update(data)
+        self.size += len(data)
+
+        if self.path is None and not self.budget.take(len(data)):
+            self._spill()
+        return self._file.write(data)
+
+    def _spill(self):
+        self.path = os.path.join(self.directory, f".{uuid.uuid4().hex}.upload")
+        os.makedirs(self.directory, exist_ok=True)
+        spooled = open(self.path, 'w+b')
+        held = self._file.getbuffer()
+        spooled.write(held)
+        self.budget.give_back(len(held))
+        del held
+        self._file = spooled
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readinto(self, buffer):
+        data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    # Refuse bodies too short to have shown a PDF header, or with no
+    # end-of-file marker anywhere
+    def check(self):
+        if b"%PDF-" not in self.head:
+            raise UnsupportedMediaType("Uploaded file is not a PDF")
+        if b"%%EOF" not in self.tail and not self._find_eof_marker():
+            raise BadRequest("Uploaded PDF is incomplete")
+
+    def _find_eof_marker(self):
+        position = self._file.tell()
+        try:
+            end = self.size
+            following = b""
+            while end > 0:
+                start = max(0, end - SEARCH_CHUNK_SIZE)
+                self._file.seek(start)
+                chunk = self._file.read(end - start)
+                # A few bytes of the following chunk catch markers that
+                # straddle the boundary
+                if b"%%EOF" in chunk + following:
+                    return True
+                following = chunk[:4]
+                end = start
+            return False
+        finally:
+            self._file.seek(position)
+
+    # Bytes of an upload still held in memory
+    def getvalue(self):
+        return self._file.getvalue()
+
+    # The buffer of an upload still held in memory, rewound, handed over to
+    # the caller without copying; the stream is left empty
+    def take_buffer(self):
+        buffer, self._file = self._file, io.BytesIO()
+        buffer.seek(0)
+        return buffer
+
+    # Move a spilled upload to path (same file system), or write it there
+    def move_to(self, path):
+        if self.path is None:
+            with open(path, 'wb') as output_file:
+                output_file.write(self._file.getvalue())
+            return
+        self._file.close()
+        shutil.move(self.path, path)
+        self.path = None
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+        super().close()
+
+
+# The uploads of a request share one IN_MEMORY_THRESHOLD budget, so many
+# files can't add up to more than that in memory while the body is parsed
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if 'upload_budget' not in self.__dict__:
+            self.upload_budget = MemoryBudget(current_app.config['IN_MEMORY_THRESHOLD'])
+        return UploadStream(current_app.config['UPLOAD_SPOOL_FOLDER'], self.upload_budget)
+
+
+# Parse an app's uploads with UploadStream and cap request bodies at
+# MAX_CONTENT_LENGTH (larger requests get 413 before their body is read)
+def init_app(app):
+    if app.config.get('MAX_CONTENT_LENGTH') is None:
+        app.config['MAX_CONTENT_LENGTH'] = 512 * 1024 * 1024
+    app.config.setdefault('IN_MEMORY_THRESHOLD', 5 * 1024 * 1024)
+    app.config.setdefault('UPLOAD_SPOOL_FOLDER', app.config['UPLOAD_FOLDER'])
+    app.request_class = UploadRequest
+
+
+# Save an uploaded file to path after checking it is a whole PDF
+def save_file(file, path):
+    if isinstance(file.stream, UploadStream):
+        file.stream.check()
+        file.stream.move_to(path)
+    else:
+        file.save(path)